@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Yoshihisa Tanaka
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Throughput and latency benchmarks against a local fake fluentd.
+
+Every scenario sends ``--events`` records through one client and reports the
+throughput (events delivered per second) and the p50/p99 latency of a single
+send call. Clients are given ``CLOSE_TIMEOUT`` seconds to transmit their queue
+when they are closed, and events which were not delivered are reported as
+``unsent``. Results are printed as JSON lines; ``--output`` stores them in a
+JSON document which can be given to ``--compare`` on a later run.
+
+  $ python benchmarks/bench.py --events 20000 --output before.json
+  $ python benchmarks/bench.py --events 20000 --compare before.json
+
+``--transports tcp unix`` compares TCP loopback with a Unix domain socket.
+"""
+
+from __future__ import print_function
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import platform
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from fakefluentd import FakeFluentd  # noqa: E402
+from pyfluent import client  # noqa: E402
+import pyfluent.logging  # noqa: E402
+
+clock = getattr(time, 'perf_counter', time.time)
+
+CLIENTS = ['sender', 'async_sender', 'send_many', 'safe_handler', 'handler']
+MODES = [
+    client.MESSAGE_MODE, client.FORWARD_MODE, client.PACKED_FORWARD_MODE,
+    client.COMPRESSED_PACKED_FORWARD_MODE
+]
+SIZES = {'small': 64, 'medium': 1024, 'large': 16384}
+CONDITIONS = ['normal', 'slow_reader', 'server_down']
+TRANSPORTS = ['tcp', 'unix']
+# seconds given to a client to transmit its queue when it is closed
+CLOSE_TIMEOUT = 60
+
+
+def make_server(condition, transport):
+    kwargs = {}
+    if transport == 'unix':
+        kwargs['path'] = unix_socket_path()
+    if condition == 'slow_reader':
+        return FakeFluentd(read_delay=0.0005, recv_size=4096, **kwargs)
+    return FakeFluentd(**kwargs)
+
+
+def unix_socket_path(counter=itertools.count()):
+    return os.path.join(tempfile.gettempdir(), 'pyfluent-bench-%d-%d.sock' % (
+        os.getpid(), next(counter)))
+
+
+def unused_address(transport):
+    if transport == 'unix':
+        return 'unix://' + unix_socket_path(), None
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return '127.0.0.1', port
+
+
+def make_client(name, mode, host, port):
+    """Return the send and close callables of the benchmarked client.
+
+    The third item is the FluentSender used by the client, or None for
+    FluentHandler, which writes to its socket in ``send``.
+    """
+    if name in ('sender', 'async_sender'):
+        cls = name == 'sender' and client.FluentSender or \
+            client.AsyncFluentSender
+        sender = cls(host, port, 'bench', mode=mode)
+        return sender.send, sender.close, sender
+
+    if name == 'send_many':
+        sender = client.FluentSender(host, port, 'bench', mode=mode)
+        return sender.send_many, sender.close, sender
+
+    sender = None
+    if name == 'safe_handler':
+        handler = pyfluent.logging.SafeFluentHandler(
+            host, port, 'bench', mode=mode)
+        sender = handler.fluent
+    else:
+        handler = pyfluent.logging.FluentHandler(host, port, 'bench')
+    logger = logging.Logger('pyfluent.bench.%s' % name)
+    logger.propagate = False
+    logger.addHandler(handler)
+    return logger.info, handler.close, sender
+
+
+def percentile(values, percent):
+    if not values:
+        return 0.0
+    index = min(int(len(values) * percent / 100.0), len(values) - 1)
+    return values[index]
+
+
+def run(name, mode, size, condition, transport, threads, events):
+    server = None
+    if condition == 'server_down':
+        host, port = unused_address(transport)
+    else:
+        server = make_server(condition, transport).start()
+        host, port = server.host, server.port
+    send, close, sender = make_client(name, mode, host, port)
+    payload = 'x' * SIZES[size]
+    latencies = []
+
+    def worker(count):
+        if name == 'send_many':
+            # a single call streaming all events; no per-event latency
+            send((None, None, payload) for i in range(count))
+            return
+        for i in range(count):
+            t = clock()
+            send(payload)
+            latencies.append(clock() - t)
+
+    start = clock()
+    workers = [threading.Thread(target=worker, args=(events // threads, ))
+               for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    if sender is not None and server:
+        # close flushes for up to the timeout of the sender
+        sender.timeout = CLOSE_TIMEOUT
+    close()
+    events = events // threads * threads
+    delivered = 0
+    if server:
+        if sender is not None:
+            # only wait for what the client managed to transmit
+            server.wait_bytes(sender.bytes_sent, timeout=CLOSE_TIMEOUT)
+        else:
+            server.wait(events, timeout=CLOSE_TIMEOUT)
+        delivered = server.events
+        server.stop()
+    elapsed = clock() - start
+
+    latencies.sort()
+    return {
+        'client': name,
+        'mode': mode,
+        'size': size,
+        'condition': condition,
+        'transport': transport,
+        'threads': threads,
+        'events': events,
+        'delivered': delivered,
+        'unsent': events - delivered,
+        'seconds': round(elapsed, 6),
+        'throughput': round(delivered / elapsed, 1),
+        'p50': percentile(latencies, 50),
+        'p99': percentile(latencies, 99),
+        'max': latencies and latencies[-1] or 0.0
+    }
+
+
+def scenarios(args):
+    for name, mode, size, condition, transport, threads in itertools.product(
+            args.clients, args.modes, args.sizes, args.conditions,
+            args.transports, args.threads):
+        if name == 'handler' and mode != client.MESSAGE_MODE:
+            continue
+        if name in ('sender', 'send_many') and threads > 1:
+            # FluentSender must not be shared by threads
+            continue
+        yield name, mode, size, condition, transport, threads
+
+
+def compare(results, filename):
+    with open(filename) as f:
+        previous = json.load(f)['results']
+    key = lambda r: (r['client'], r['mode'], r['size'], r['condition'],
+                     r.get('transport', 'tcp'), str(r.get('threads', 1)))
+    previous = dict((key(r), r) for r in previous)
+    for result in results:
+        old = previous.get(key(result))
+        if not old:
+            continue
+        print('%-60s throughput %6.2fx  p99 %6.2fx' % (
+            '/'.join(key(result)),
+            old['throughput'] and result['throughput'] / old['throughput'],
+            old['p99'] and result['p99'] / old['p99']), file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--events', type=int, default=10000)
+    parser.add_argument('--clients', nargs='+', default=CLIENTS,
+                        choices=CLIENTS)
+    parser.add_argument('--modes', nargs='+', default=MODES, choices=MODES)
+    parser.add_argument('--sizes', nargs='+', default=sorted(SIZES),
+                        choices=sorted(SIZES))
+    parser.add_argument('--conditions', nargs='+', default=['normal'],
+                        choices=CONDITIONS)
+    parser.add_argument('--transports', nargs='+', default=['tcp'],
+                        choices=TRANSPORTS)
+    parser.add_argument('--threads', nargs='+', type=int, default=[1],
+                        help='numbers of threads sending concurrently')
+    parser.add_argument('--output', help='write results as JSON')
+    parser.add_argument('--compare', help='compare with a previous output')
+    args = parser.parse_args(argv)
+
+    results = []
+    for scenario in scenarios(args):
+        result = run(*(scenario + (args.events,)))
+        results.append(result)
+        print(json.dumps(result, sort_keys=True))
+        sys.stdout.flush()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'time': time.time(),
+                'results': results
+            }, f, indent=2, sort_keys=True)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
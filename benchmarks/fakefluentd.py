@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Yoshihisa Tanaka
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A minimal fluentd in_forward server for benchmarks.
+
+It decodes Message, Forward, PackedForward and CompressedPackedForward
+frames and counts the received events and bytes. The server runs in a
+thread of the current process or in a forked process, so that it does not
+compete with the benchmarked client for the GIL.
+"""
+
+import multiprocessing
+import os
+import select
+import socket
+import threading
+import time
+import zlib
+
+import msgpack
+
+# a packed forward payload can be larger than msgpack's default limits
+MAX_BUFFER_SIZE = 64 * 1024 * 1024
+
+
+def gzip_decompress(data):
+    result = []
+    while data:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        result.append(decompressor.decompress(data))
+        data = decompressor.unused_data
+    return b''.join(result)
+
+
+def get_option(obj):
+    """Return the option of a decoded frame, or an empty dict."""
+    if len(obj) == 4:
+        return obj[3] or {}
+    if len(obj) == 3 and isinstance(obj[1], (list, tuple, bytes)):
+        return obj[2] or {}
+    return {}
+
+
+def get_chunk(obj):
+    option = get_option(obj)
+    return option.get(b'chunk') or option.get('chunk')
+
+
+def count_events(obj):
+    """Return the number of events in a decoded forward protocol frame."""
+    entries = obj[1]
+    if isinstance(entries, (list, tuple)):
+        return len(entries)
+    if isinstance(entries, bytes):
+        option = get_option(obj)
+        compressed = option.get(b'compressed') or option.get('compressed')
+        if compressed in (b'gzip', 'gzip'):
+            entries = gzip_decompress(entries)
+        unpacker = msgpack.Unpacker(max_buffer_size=MAX_BUFFER_SIZE)
+        unpacker.feed(entries)
+        return sum(1 for _ in unpacker)
+    return 1
+
+
+class Counter(object):
+    def __init__(self, shared):
+        if shared:
+            self._events = multiprocessing.Value('q', 0)
+            self._bytes = multiprocessing.Value('q', 0)
+        else:
+            self._events = _Value()
+            self._bytes = _Value()
+
+    @property
+    def events(self):
+        return self._events.value
+
+    @property
+    def bytes(self):
+        return self._bytes.value
+
+    def add(self, events, size):
+        self._events.value += events
+        self._bytes.value += size
+
+    def reset(self):
+        self._events.value = 0
+        self._bytes.value = 0
+
+
+class _Value(object):
+    value = 0
+
+
+class FakeFluentd(object):
+    """Forward protocol server counting received events.
+
+    ``read_delay`` makes the server sleep after every ``recv`` to emulate a
+    slow aggregator. Frames carrying a ``chunk`` option are acknowledged.
+    If ``path`` is given, the server listens on that Unix domain socket and
+    ``host`` is the ``unix://`` address to pass to the clients.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, fork=True, read_delay=0,
+                 recv_size=65536, path=None):
+        self.read_delay = read_delay
+        self.recv_size = recv_size
+        self.fork = fork
+        self.path = path
+        self.counter = Counter(fork)
+        if path:
+            self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._listener.bind(path)
+            self.host, self.port = 'unix://' + path, None
+        else:
+            self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._listener.setsockopt(socket.SOL_SOCKET,
+                                      socket.SO_REUSEADDR, 1)
+            self._listener.bind((host, port))
+            self.host, self.port = self._listener.getsockname()[:2]
+        self._listener.listen(16)
+        self._worker = None
+        self._stop = None
+
+    @property
+    def events(self):
+        return self.counter.events
+
+    @property
+    def bytes(self):
+        return self.counter.bytes
+
+    def start(self):
+        if self.fork:
+            context = multiprocessing
+            if hasattr(multiprocessing, 'get_context'):
+                context = multiprocessing.get_context('fork')
+            self._stop = context.Event()
+            self._worker = context.Process(target=self.serve)
+        else:
+            self._stop = threading.Event()
+            self._worker = threading.Thread(target=self.serve)
+        self._worker.daemon = True
+        self._worker.start()
+        return self
+
+    def stop(self):
+        if self._worker:
+            self._stop.set()
+            self._worker.join(5)
+            self._worker = None
+        self._listener.close()
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def wait(self, events, timeout=30):
+        """Wait until ``events`` events are received."""
+        deadline = time.time() + timeout
+        while self.events < events and time.time() < deadline:
+            time.sleep(0.001)
+        return self.events >= events
+
+    def wait_bytes(self, size, timeout=30):
+        """Wait until ``size`` bytes are received."""
+        deadline = time.time() + timeout
+        while self.bytes < size and time.time() < deadline:
+            time.sleep(0.001)
+        return self.bytes >= size
+
+    def serve(self):
+        clients = {}
+        try:
+            while not self._stop.is_set():
+                socks = [self._listener] + list(clients)
+                readable = select.select(socks, [], [], 0.1)[0]
+                for sock in readable:
+                    if sock is self._listener:
+                        conn = self._listener.accept()[0]
+                        clients[conn] = msgpack.Unpacker(
+                            max_buffer_size=MAX_BUFFER_SIZE)
+                        continue
+                    try:
+                        data = sock.recv(self.recv_size)
+                    except socket.error:
+                        data = b''
+                    if not data:
+                        sock.close()
+                        del clients[sock]
+                        continue
+                    unpacker = clients[sock]
+                    unpacker.feed(data)
+                    events = 0
+                    acks = []
+                    for obj in unpacker:
+                        events += count_events(obj)
+                        chunk = get_chunk(obj)
+                        if chunk:
+                            acks.append(msgpack.packb({'ack': chunk}))
+                    if acks:
+                        sock.sendall(b''.join(acks))
+                    self.counter.add(events, len(data))
+                    if self.read_delay:
+                        time.sleep(self.read_delay)
+        finally:
+            for sock in clients:
+                sock.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Yoshihisa Tanaka
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import asyncio
+import time
+
+from pyfluent.client import FluentSender, unix_path
+
+
+class AsyncioFluentSender(FluentSender):
+    """FluentSender for asyncio applications.
+
+    Messages are serialized exactly like FluentSender and transmitted by a
+    task running on the event loop, so sending never blocks the loop nor
+    needs an executor.
+    """
+
+    def __init__(self, *args, **kwargs):
+        FluentSender.__init__(self, *args, **kwargs)
+        self._reader = None
+        self._writer = None
+        self._task = None
+        self._wakeup = None
+        self._written = None
+        self._sent = 0
+        self._queued = 0
+        self._inflight = 0
+        self._flush_requested = False
+        self._closing = False
+        self._close_deadline = 0
+
+    def _ensure_task(self):
+        if self._task and not self._task.done():
+            return
+        self._closing = False
+        self._wakeup = asyncio.Event()
+        self._written = asyncio.Event()
+        self._task = asyncio.ensure_future(self._run())
+
+    def send_nowait(self, data, tag=None, timestamp=None):
+        """Queue a message without waiting for it to be transmitted."""
+        self._ensure_task()
+        now = time.time()
+        self._report(now)
+        if not self._allow(tag, now):
+            return False
+        if self._append(data, tag, timestamp) or self._batch_count == 1:
+            # frames taken by the writer are sent before the queue
+            self._queued = self._sent + self._inflight + len(self._queue)
+            if self._spill is not None:
+                self._queued += len(self._spill)
+            self._wakeup.set()
+            return True
+        return False
+
+    async def send(self, data, tag=None, timestamp=None):
+        """Queue a message and wait until queued messages are transmitted.
+
+        Like FluentSender.send, this waits at most ``self.timeout`` seconds.
+        In batching modes it returns immediately unless the batch is full.
+        """
+        if self.send_nowait(data, tag, timestamp):
+            await self._wait_for(lambda seq=self._queued: self._sent >= seq,
+                                 self.timeout)
+
+    async def send_many(self, events):
+        """Send ``(tag, timestamp, data)`` tuples read from an iterable.
+
+        Like FluentSender.send_many, reading waits while more than
+        ``batch_bytes`` bytes are queued, and frames which do not fit in
+        time are spilled or dropped. Returns the number of events queued.
+        """
+        self._ensure_task()
+        self._flush_batches()
+        count = 0
+        for frame, number in self._stream_frames(events):
+            self.events += number
+            count += number
+            if self._stream_room() or await self._wait_for(
+                    self._stream_room, self._stream_timeout()):
+                self._enqueue(frame)
+            else:
+                self._shed(frame)
+            self._wakeup.set()
+        return count
+
+    async def flush(self, timeout=None):
+        """Wait until all queued messages are transmitted.
+
+        Returns False if they could not be transmitted within ``timeout``
+        seconds (defaults to ``self.timeout``).
+        """
+        if not self._task or self._task.done():
+            return not (self._pending() or self._batch_count)
+        if timeout is None:
+            timeout = self.timeout
+        self._flush_requested = True
+        self._wakeup.set()
+        try:
+            return await self._wait_for(
+                lambda: not (self._pending() or self._batch_count), timeout)
+        finally:
+            self._flush_requested = False
+
+    async def aclose(self, timeout=None):
+        """Flush queued messages and close the connection.
+
+        Messages which could not be transmitted within ``timeout`` seconds
+        (defaults to ``self.timeout``) are kept in the queue.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        task = self._task
+        if task and not task.done():
+            self._closing = True
+            self._close_deadline = time.time() + timeout
+            self._wakeup.set()
+            await asyncio.wait([task], timeout=timeout)
+            if not task.done():
+                task.cancel()
+        self._disconnect()
+        if self._spill is not None:
+            self._spill.close()
+
+    def close(self):
+        """Close the connection without flushing. Prefer ``aclose``."""
+        if self._task and not self._task.done():
+            self._task.cancel()
+        self._disconnect()
+        if self._spill is not None:
+            self._spill.close()
+
+    def stats(self):
+        stats = FluentSender.stats(self)
+        stats['connected'] = self._writer is not None
+        return stats
+
+    def _after_fork(self):
+        FluentSender._after_fork(self)
+        self._reader = self._writer = self._task = None
+        self._inflight = 0
+
+    def _pending_frames(self):
+        return self._inflight or FluentSender._pending_frames(self)
+
+    def _wait_for_room(self, size):
+        # the event loop cannot block; BLOCK behaves like DROP_NEWEST
+        return False
+
+    async def _wait_for(self, predicate, timeout):
+        deadline = time.time() + timeout
+        while not predicate():
+            remaining = deadline - time.time()
+            if remaining <= 0 or self._task.done():
+                return False
+            try:
+                await asyncio.wait_for(self._written.wait(), remaining)
+            except asyncio.TimeoutError:
+                return predicate()
+        return True
+
+    def _delay(self):
+        now = time.time()
+        delays = []
+        if self._pending():
+            if self._writer or self._retry_time <= now:
+                return 0
+            delays.append(self._retry_time - now)
+        if self._batch_count:
+            if self._closing or self._flush_requested:
+                return 0
+            delays.append(self._batch_started + self.batch_interval - now)
+        if self._closing:
+            if not delays:
+                return 0
+            delays.append(self._close_deadline - now)
+        if not delays:
+            return None
+        return max(min(delays), 0)
+
+    async def _run(self):
+        while True:
+            delay = self._delay()
+            if delay != 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            if self._batch_count and (self._closing or
+                                      self._flush_requested or
+                                      self._batch_full()):
+                self._flush_batches()
+            if self._pending():
+                await self._write_queue()
+
+            written, self._written = self._written, asyncio.Event()
+            written.set()
+            if self._closing and (not self._pending() or
+                                  self._close_deadline <= time.time()):
+                return
+
+    async def _connect(self):
+        if self._writer:
+            if not self._reader.at_eof():
+                return self._writer
+            self._disconnect()
+        now = time.time()
+        if self._retry_time > now:
+            return None
+        self.connects += 1
+        try:
+            path = unix_path(self.host)
+            if path is not None:
+                connection = asyncio.open_unix_connection(path)
+            else:
+                connection = asyncio.open_connection(self.host, self.port)
+            self._reader, self._writer = await asyncio.wait_for(
+                connection, self.timeout)
+            self._reset_retry()
+        except (OSError, asyncio.TimeoutError):
+            self.connect_failures += 1
+            self._retry_time = now + next(self._wait_time)
+        return self._writer
+
+    async def _write_queue(self):
+        writer = await self._connect()
+        if not writer:
+            return
+        count = len(self._queue)
+        if self.require_ack:
+            count = min(count, self.ack_window - len(self._unacked))
+        frames = [self._queue.popleft() for i in range(count)]
+        queue_bytes = sum(len(x) for x in frames)
+        self._queue_bytes -= queue_bytes
+        self._inflight = len(frames)
+        try:
+            writer.writelines(frames)
+            await asyncio.wait_for(writer.drain(), self.timeout)
+            self._sent += len(frames)
+            self.frames_sent += len(frames)
+            self.bytes_sent += queue_bytes
+        except (OSError, asyncio.TimeoutError):
+            self._requeue(frames)
+            self._disconnect()
+            return
+        finally:
+            self._inflight = 0
+        for frame in frames:
+            self._track(frame)
+        if self._spill is not None and not len(self._queue):
+            await self._replay_spill(writer)
+        if self._unacked:
+            await self._wait_acks()
+
+    async def _replay_spill(self, writer):
+        frame = self._spill.peek()
+        try:
+            while frame is not None and self._window_open():
+                writer.write(frame)
+                await asyncio.wait_for(writer.drain(), self.timeout)
+                self._spill.pop()
+                self._sent += 1
+                self.frames_sent += 1
+                self.bytes_sent += len(frame)
+                self._track(frame)
+                frame = self._spill.peek()
+        except (OSError, asyncio.TimeoutError):
+            self._disconnect()
+
+    async def _wait_acks(self):
+        reader = self._reader
+        while self._unacked and reader is self._reader:
+            remaining = self._ack_deadline() - time.time()
+            if remaining <= 0:
+                self.retried += len(self._unacked)
+                self._disconnect()
+                return
+            try:
+                data = await asyncio.wait_for(reader.read(65536),
+                                              min(remaining, self.timeout))
+            except asyncio.TimeoutError:
+                if self._window_open() and self._pending_frames():
+                    return
+                continue
+            except OSError:
+                self._disconnect()
+                return
+            if not data:
+                self._disconnect()
+                return
+            self._read_acks(data)
+
+    def _disconnect(self):
+        FluentSender._disconnect(self)
+        if self._writer:
+            self._writer.close()
+        self._reader = self._writer = None
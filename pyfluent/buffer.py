@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Yoshihisa Tanaka
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import mmap
+import struct
+import threading
+import zlib
+
+_HEADER = struct.Struct('>II')
+_SUFFIX = '.seg'
+
+
+class FileBuffer(object):
+    """Append-only on-disk queue of serialized frames.
+
+    Frames are appended to segment files in ``path`` and read back in order
+    through a memory map. Each frame is stored with its length and CRC32, so
+    a torn write left by a crash is detected and truncated at startup.
+    A segment is removed once all of its frames are consumed; a segment
+    which was partially consumed before a crash is replayed from its start.
+    """
+
+    def __init__(self, path, segment_size=16 * 1024 * 1024,
+                 max_size=1024 * 1024 * 1024):
+        self.path = path
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self._segments = []
+        self._count = 0
+        self._size = 0
+        self._offset = 0
+        self._map = None
+        self._file = None
+        self._lock = threading.RLock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._recover()
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def size(self):
+        return self._size
+
+    def _recover(self):
+        names = sorted(x for x in os.listdir(self.path) if x.endswith(_SUFFIX))
+        for name in names:
+            filename = os.path.join(self.path, name)
+            count, size = self._scan(filename)
+            if not count:
+                os.remove(filename)
+                continue
+            self._segments.append([int(name[:-len(_SUFFIX)]), size])
+            self._count += count
+            self._size += size
+
+    def _scan(self, filename):
+        f = open(filename, 'r+b')
+        try:
+            data = f.read()
+            count = offset = 0
+            while offset + _HEADER.size <= len(data):
+                length, crc = _HEADER.unpack_from(data, offset)
+                end = offset + _HEADER.size + length
+                if end > len(data):
+                    break
+                frame = data[offset + _HEADER.size:end]
+                if zlib.crc32(frame) & 0xffffffff != crc:
+                    break
+                count += 1
+                offset = end
+            if offset < len(data):
+                f.truncate(offset)
+            return count, offset
+        finally:
+            f.close()
+
+    def _filename(self, seqno):
+        return os.path.join(self.path, '%020d%s' % (seqno, _SUFFIX))
+
+    def _writer(self):
+        if not self._segments or self._segments[-1][1] >= self.segment_size:
+            if self._file:
+                self._file.close()
+                self._file = None
+            seqno = self._segments and self._segments[-1][0] + 1 or 0
+            self._segments.append([seqno, 0])
+        if not self._file:
+            self._file = open(self._filename(self._segments[-1][0]), 'ab', 0)
+        return self._file
+
+    def append(self, frame):
+        """Append a frame. Returns False if the buffer is full."""
+        record_size = _HEADER.size + len(frame)
+        header = _HEADER.pack(len(frame), zlib.crc32(frame) & 0xffffffff)
+        self._lock.acquire()
+        try:
+            if self._size + record_size > self.max_size:
+                return False
+            self._writer().write(header + frame)
+            self._segments[-1][1] += record_size
+            self._count += 1
+            self._size += record_size
+            return True
+        finally:
+            self._lock.release()
+
+    def peek(self):
+        """Return the oldest frame, or None if the buffer is empty."""
+        self._lock.acquire()
+        try:
+            if not self._count:
+                return None
+            length = self._head()
+            start = self._offset + _HEADER.size
+            return self._map[start:start + length]
+        finally:
+            self._lock.release()
+
+    def pop(self):
+        """Discard the oldest frame."""
+        self._lock.acquire()
+        try:
+            if not self._count:
+                return
+            self._offset += _HEADER.size + self._head()
+            self._count -= 1
+            if not self._count:
+                self.clear()
+        finally:
+            self._lock.release()
+
+    def _head(self):
+        if self._offset >= self._segments[0][1]:
+            self._remove_first()
+        seqno, size = self._segments[0]
+        if self._map is None or len(self._map) < size:
+            self._remap(seqno)
+        return _HEADER.unpack_from(self._map, self._offset)[0]
+
+    def _remap(self, seqno):
+        self._unmap()
+        f = open(self._filename(seqno), 'rb')
+        try:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+    def _unmap(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def _remove_first(self):
+        seqno, size = self._segments.pop(0)
+        self._unmap()
+        os.remove(self._filename(seqno))
+        self._size -= size
+        self._offset = 0
+
+    def clear(self):
+        """Remove all frames and segment files."""
+        self._lock.acquire()
+        try:
+            self.close()
+            for seqno, size in self._segments:
+                os.remove(self._filename(seqno))
+            self._segments = []
+            self._count = self._size = self._offset = 0
+        finally:
+            self._lock.release()
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            self._unmap()
+            if self._file:
+                self._file.close()
+                self._file = None
+        finally:
+            self._lock.release()
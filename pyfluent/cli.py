@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Yoshihisa Tanaka
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Ship JSON lines or msgpack records to fluentd.
+
+Records are read from the files given, or from the standard input, and sent
+with FluentSender.send_many.
+"""
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import json
+import sys
+import time
+
+import msgpack
+
+from pyfluent import client
+from pyfluent.client import PackedRecord
+
+MODES = {
+    'message': client.MESSAGE_MODE,
+    'forward': client.FORWARD_MODE,
+    'packed_forward': client.PACKED_FORWARD_MODE,
+    'compressed_packed_forward': client.COMPRESSED_PACKED_FORWARD_MODE,
+}
+
+READ_SIZE = 1024 * 1024
+
+
+def read_json(f, args, errors):
+    """Yield ``(tag, timestamp, record)`` from JSON lines."""
+    for lineno, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+        try:
+            item = event(json.loads(line.decode('utf-8')), args)
+        except ValueError as e:
+            errors.append('%s:%d: %s' % (f.name, lineno, e))
+            continue
+        yield item
+
+
+def read_msgpack(f, args, errors):
+    """Yield ``(tag, timestamp, record)`` from a stream of msgpack objects.
+
+    Objects are maps (records) or ``[tag, time, record]`` arrays. Unless a
+    tag or time key is given, maps are sent as they are read, without
+    being decoded.
+    """
+    decode = args.tag_key or args.time_key
+    unpacker = msgpack.Unpacker(encoding='utf-8',
+                                max_buffer_size=2 ** 31 - 1)
+    buf = bytearray()
+    offset = 0
+    index = 0
+    while True:
+        data = f.read(READ_SIZE)
+        if not data:
+            break
+        unpacker.feed(data)
+        buf.extend(data)
+        start = 0
+        while True:
+            try:
+                unpacker.skip()
+            except msgpack.OutOfData:
+                break
+            end = unpacker.tell() - offset
+            raw = bytes(buf[start:end])
+            start = end
+            index += 1
+            if not decode and is_map(raw):
+                yield None, None, PackedRecord(raw)
+                continue
+            try:
+                obj = msgpack.unpackb(raw, encoding='utf-8')
+                if isinstance(obj, (list, tuple)) and len(obj) == 3:
+                    item = obj[0], parse_time(obj[1]), obj[2]
+                else:
+                    item = event(obj, args)
+            except (UnicodeDecodeError, ValueError) as e:
+                errors.append('%s: object %d: %s' % (f.name, index, e))
+                continue
+            yield item
+        del buf[:start]
+        offset += start
+    if buf:
+        errors.append('%s: truncated msgpack object' % f.name)
+
+
+def is_map(raw):
+    first = ord(raw[:1])
+    return 0x80 <= first <= 0x8f or first in (0xde, 0xdf)
+
+
+def event(record, args):
+    tag = timestamp = None
+    if isinstance(record, dict):
+        if args.tag_key:
+            tag = record.pop(args.tag_key, None)
+        if args.time_key:
+            timestamp = parse_time(record.pop(args.time_key, None))
+    return tag, timestamp, record
+
+
+def parse_time(value):
+    """Return the time of an event as a number, or None for the default.
+
+    Numbers, EventTime extensions, numeric strings and ISO 8601 strings
+    are accepted; ISO 8601 times without an offset are in UTC. Raises
+    ValueError for anything else.
+    """
+    if value is None or isinstance(value, msgpack.ExtType) and \
+            value.code == 0:
+        return value
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            pass
+        if value.endswith('Z'):
+            value = value[:-1] + '+00:00'
+        try:
+            dt = datetime.datetime.fromisoformat(value)
+        except ValueError:
+            pass
+        else:
+            if dt.tzinfo is None:
+                dt = dt.replace(tzinfo=datetime.timezone.utc)
+            return dt.timestamp()
+    raise ValueError('invalid time: %r' % (value, ))
+
+
+class Progress(object):
+    """Counts events and reports the throughput every ``interval`` seconds."""
+
+    def __init__(self, sender, interval, out=sys.stderr):
+        self.sender = sender
+        self.interval = interval
+        self.out = out
+        self.events = 0
+        self.started = self.reported = time.time()
+
+    def count(self, events):
+        interval = self.interval
+        for item in events:
+            self.events += 1
+            if not self.events & 0x3ff:
+                now = time.time()
+                if now - self.reported >= interval:
+                    self.reported = now
+                    self.report(now)
+            yield item
+
+    def report(self, now=None):
+        elapsed = max((now or time.time()) - self.started, 1e-9)
+        sent = self.sender.bytes_sent
+        print('%d events, %d bytes sent in %.1fs: %.0f events/s, %.1f MB/s' % (
+            self.events, sent, elapsed, self.events / elapsed,
+            sent / elapsed / 1e6), file=self.out)
+
+
+def open_inputs(paths):
+    for path in paths or ['-']:
+        if path == '-':
+            yield getattr(sys.stdin, 'buffer', sys.stdin)
+        else:
+            with open(path, 'rb') as f:
+                yield f
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        prog='pyfluent-cat', description=__doc__.splitlines()[0])
+    parser.add_argument('files', nargs='*', metavar='FILE',
+                        help='files to read; - or none for the standard input')
+    parser.add_argument('--host', default='localhost',
+                        help='fluentd host, or unix:// followed by a path')
+    parser.add_argument('--port', type=int, default=24224)
+    parser.add_argument('--tag', default='pyfluent.cat')
+    parser.add_argument('--format', choices=['json', 'msgpack'],
+                        default='json')
+    parser.add_argument('--tag-key', help='take the tag from this key')
+    parser.add_argument('--time-key', help='take the time from this key: '
+                        'a number or an ISO 8601 string')
+    parser.add_argument('--mode', choices=sorted(MODES),
+                        default='packed_forward')
+    parser.add_argument('--batch-size', type=int, default=10000)
+    parser.add_argument('--batch-bytes', type=int, default=1024 * 1024)
+    parser.add_argument('--compresslevel', type=int, default=1)
+    parser.add_argument('--require-ack', action='store_true')
+    parser.add_argument('--timeout', type=float, default=30,
+                        help='seconds to wait for fluentd to read')
+    parser.add_argument('--max-queue-bytes', type=int,
+                        default=64 * 1024 * 1024)
+    parser.add_argument('--progress', type=float, default=0, metavar='SEC',
+                        help='report the throughput every SEC seconds')
+    return parser
+
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+    sender = client.FluentSender(
+        args.host, args.port, args.tag, timeout=args.timeout,
+        mode=MODES[args.mode], batch_size=args.batch_size,
+        batch_bytes=args.batch_bytes, compresslevel=args.compresslevel,
+        require_ack=args.require_ack, max_queue_bytes=args.max_queue_bytes,
+        overflow=client.BLOCK, block_timeout=args.timeout)
+    reader = args.format == 'json' and read_json or read_msgpack
+    progress = Progress(sender, args.progress)
+    errors = []
+    try:
+        for f in open_inputs(args.files):
+            events = reader(f, args, errors)
+            if args.progress:
+                events = progress.count(events)
+            sender.send_many(events)
+            for error in errors:
+                print(error, file=sys.stderr)
+            del errors[:]
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sender.close()
+    if args.progress:
+        progress.report()
+    stats = sender.stats()
+    unsent = stats['queue_length'] + stats['unacked']
+    if stats['dropped'] or unsent:
+        print('%d frames dropped, %d frames not sent' % (
+            stats['dropped'], unsent), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
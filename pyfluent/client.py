@@ -13,31 +13,169 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 import sys
 import time
+import base64
 import socket
 import select
 import errno
-from collections import deque
+import threading
+import struct
+import zlib
+from collections import OrderedDict, deque
+from itertools import islice
+
+try:
+    from weakref import WeakSet
+except ImportError:
+    WeakSet = None
 
 import msgpack
 
+from pyfluent.buffer import FileBuffer
+from pyfluent.clock import Clock, EventTime
+from pyfluent import encoder
+from pyfluent.resolver import Resolver
+from pyfluent.stats import Histogram
+
 if sys.version_info[:2] <= (2, 5):
     next = lambda iter: iter.next()
 
+MESSAGE_MODE = 'message'
+FORWARD_MODE = 'forward'
+PACKED_FORWARD_MODE = 'packed_forward'
+COMPRESSED_PACKED_FORWARD_MODE = 'compressed_packed_forward'
+
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+BLOCK = 'block'
+
+ROUND_ROBIN = 'round_robin'
+LEAST_PENDING = 'least_pending'
+
+DEFAULT_SPILL_CAPACITY = 1000
+
+UNIX_SCHEME = 'unix://'
+
+# senders of this process, reset in the child after os.fork
+_senders = None
+if WeakSet is not None:
+    _senders = WeakSet()
+# without fork hooks, a changed pid tells a sender that it was forked
+CHECK_PID = not hasattr(os, 'register_at_fork')
+
+# frames gathered into a single sendmsg call
+MAX_IOV = 64
+
+# msgpack headers of small arrays, to assemble frames from packed parts
+ARRAY2 = b'\x92'
+ARRAY3 = b'\x93'
+ARRAY4 = b'\x94'
+
+_pack_float = struct.Struct('>Bd').pack
+
 
 class FluentSender(object):
+    _blocking_select = False
+    # whether send may be called from several threads at once
+    thread_safe = False
+    # shared by all senders; see pyfluent.resolver
+    resolver = Resolver()
+
     def __init__(self, host='localhost', port=24224, tag='',
-                 timeout=1, capacity=None):
+                 timeout=1, capacity=None, mode=MESSAGE_MODE,
+                 batch_size=1000, batch_bytes=1024 * 1024, batch_interval=1.0,
+                 compresslevel=6, compress_min_size=1024,
+                 spill_path=None, spill_max_size=1024 * 1024 * 1024,
+                 max_queue_bytes=None, overflow=DROP_OLDEST,
+                 block_timeout=None, stats_tag=None, stats_interval=60,
+                 require_ack=False, ack_timeout=30, ack_window=16,
+                 nanosecond_precision=False, clock_resolution=None,
+                 encoders=None, rate_limiter=None):
         self.host = host
         self.port = port
         self.tag = tag
         self.timeout = timeout
         self.capacity = capacity
+        self.mode = mode
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.batch_interval = batch_interval
+        self.compresslevel = compresslevel
+        self.compress_min_size = compress_min_size
+        self.max_queue_bytes = max_queue_bytes
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.stats_tag = stats_tag
+        self.stats_interval = stats_interval
+        self.require_ack = require_ack
+        self.ack_timeout = ack_timeout
+        self.ack_window = ack_window
+        self.clock = Clock(nanosecond_precision, clock_resolution)
+        if encoders is None:
+            encoders = encoder.registry
+        self.encoders = encoders
+        self.rate_limiter = rate_limiter
+        self._unacked = OrderedDict()
+        self._unpacker = msgpack.Unpacker(encoding='utf-8')
+        self._reset_counters()
+        self._queue_bytes = 0
+        self._spill = None
+        if spill_path:
+            self._spill = FileBuffer(spill_path, max_size=spill_max_size)
+            if capacity is None:
+                self.capacity = DEFAULT_SPILL_CAPACITY
         self._sock = None
+        self._connecting = None
+        self._connect_deadline = 0
+        self._partial = None
+        self._partial_offset = 0
+        # index of the address to connect to, among those of the host
+        self._address = 0
+        self._addresses = 0
         self._reset_retry()
         self._queue = self._make_queue()
-        self.packer = msgpack.Packer(encoding='utf-8')
+        self._reset_batches()
+        self.packer = make_packer(encoders)
+        self.tags = TagCache()
+        self._pid = os.getpid()
+        if _senders is not None:
+            _senders.add(self)
+
+    def _reset_counters(self):
+        self.events = 0
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.dropped = 0
+        self.dropped_bytes = 0
+        self.connects = 0
+        self.connect_failures = 0
+        self.acked = 0
+        self.retried = 0
+        self.send_latency = Histogram()
+        self._next_report = time.time() + self.stats_interval
+
+    def _after_fork(self):
+        """Forget the connection and queue inherited from the parent.
+
+        Frames queued before the fork are transmitted by the parent, and
+        the spill directory stays owned by the parent as well.
+        """
+        self._pid = os.getpid()
+        for sock in (self._sock, self._connecting):
+            if sock is not None:
+                sock.close()
+        self._sock = self._connecting = None
+        self._partial = None
+        self._unacked = OrderedDict()
+        self._unpacker = msgpack.Unpacker(encoding='utf-8')
+        self._queue = self._make_queue()
+        self._queue_bytes = 0
+        self._spill = None
+        self._reset_batches()
+        self._reset_retry()
+        self._reset_counters()
 
     def _reset_retry(self):
         self._retry_time = 0
@@ -48,68 +186,1134 @@ class FluentSender(object):
             return deque()
         return deque(maxlen=self.capacity)
 
+    def _reset_batches(self):
+        self._batches = {}
+        self._batch_count = 0
+        self._batch_bytes = 0
+        self._batch_started = 0
+
     @property
     def socket(self):
+        return self._connect()
+
+    def _connect(self, block=False):
         if not self._sock:
-            self._create_socket()
+            self._create_socket(block)
         return self._sock
 
-    def _create_socket(self):
+    def _create_socket(self, block=False):
+        """Start or continue a non-blocking connection attempt.
+
+        Unless ``block`` is given, this only polls the connection in
+        progress, so a slow or blackholed server never stalls ``send``.
+        """
         now = time.time()
-        if self._retry_time > now:
-            return
+        if self._connecting is None:
+            if self._retry_time > now:
+                return
+            try:
+                if block and unix_path(self.host) is None:
+                    self.resolver.lookup(self.host, self.port, self.timeout)
+                sock = self._make_socket()
+            except socket.error:
+                self.connects += 1
+                self._connect_failed(now)
+                return
+            if sock is None:
+                # the host name is being resolved
+                return
+            self.connects += 1
+            self._connecting = sock
+            self._connect_deadline = now + self.timeout
+        wait = 0
+        if block:
+            wait = max(self._connect_deadline - now, 0)
+        self._poll_connect(wait)
+
+    def _poll_connect(self, wait):
+        sock = self._connecting
         try:
-            self._sock = self._make_socket()
-            self._reset_retry()
+            if not select.select([], [sock], [], wait)[1]:
+                if self._connect_deadline > time.time():
+                    return
+                raise socket.timeout('timed out')
+            error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                raise socket.error(error, os.strerror(error))
         except socket.error:
-            self._retry_time = now + next(self._wait_time)
+            self._connecting = None
+            sock.close()
+            self._connect_failed(time.time())
+            return
+        self._connecting = None
+        self._sock = sock
+        self._reset_retry()
+
+    def _connect_failed(self, now):
+        self.connect_failures += 1
+        self._address += 1
+        if self._address < self._addresses:
+            # try the next address of the host right away
+            return
+        self._address = 0
+        self._retry_time = now + next(self._wait_time)
 
     def _make_socket(self):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(self.timeout)
-        sock.connect((self.host, self.port))
-        # cancel timeout and set nonblocking expressly
+        """Return a socket connecting to fluentd without waiting for it.
+
+        Returns None while the host name is not resolved yet.
+        """
+        path = unix_path(self.host)
+        if path is not None:
+            family, sockaddr = socket.AF_UNIX, path
+        else:
+            self._addresses = 0
+            addresses = self.resolver.lookup(self.host, self.port)
+            if addresses is None:
+                return None
+            self._addresses = len(addresses)
+            family, sockaddr = addresses[self._address % len(addresses)]
+        sock = socket.socket(family, socket.SOCK_STREAM)
         sock.setblocking(False)
+        error = sock.connect_ex(sockaddr)
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            raise socket.error(error, os.strerror(error))
         return sock
 
     def send(self, data, tag=None, timestamp=None):
-        self._queue.append(self.serialize(data, tag, timestamp))
-        deadline = time.time() + self.timeout
+        start = time.time()
+        self._report(start)
+        if not self._allow(tag, start):
+            return
+        if self._append(data, tag, timestamp):
+            self._flush_queue()
+        self.send_latency.observe(time.time() - start)
+
+    def _allow(self, tag, now):
+        limiter = self.rate_limiter
+        return limiter is None or limiter.allow(tag or self.tag, now)
+
+    def _append(self, data, tag, timestamp):
+        if CHECK_PID and self._pid != os.getpid():
+            self._after_fork()
+        self.events += 1
+        if self.mode == MESSAGE_MODE:
+            if self.require_ack:
+                self._enqueue(self._make_message(data, tag, timestamp))
+            else:
+                self._enqueue(self.serialize(data, tag, timestamp))
+            return True
+        self._add_entry(tag or self.tag, data, timestamp)
+        if not self._batch_full():
+            return False
+        self._flush_batches()
+        return True
+
+    def send_raw(self, frame):
+        """Queue a frame already serialized in the forward protocol."""
+        self._enqueue(frame)
+        self._flush_queue()
+
+    def send_many(self, events):
+        """Send ``(tag, timestamp, data)`` tuples read from an iterable.
+
+        ``tag`` and ``timestamp`` may be None for the defaults of ``send``.
+        Events are serialized as they are read into frames of about
+        ``batch_bytes`` bytes (Forward frames in batching modes), and
+        reading waits up to ``timeout`` seconds (``block_timeout`` with
+        BLOCK) while more than ``batch_bytes`` bytes are queued. Frames
+        which still do not fit go to the spill buffer, or ``overflow``
+        decides which frame is dropped, so the iterable is never held in
+        memory. Returns the number of events queued.
+        """
+        count = 0
+        for frame, number in self._stream_frames(events):
+            self._push_frame(frame, number)
+            count += number
+        return count
+
+    def _stream_frames(self, events):
+        batching = self.mode != MESSAGE_MODE
+        current = None
+        entries = []
+        size = 0
+        for tag, timestamp, data in events:
+            tag = tag or self.tag
+            if not self._allow(tag, None):
+                continue
+            if not batching:
+                if self.require_ack:
+                    yield self._make_message(data, tag, timestamp), 1
+                    continue
+                entry = self.serialize(data, tag, timestamp)
+            else:
+                if entries and tag != current:
+                    yield self._make_frame(current, entries), len(entries)
+                    entries = []
+                    size = 0
+                current = tag
+                entry = self.serialize_entry(data, timestamp)
+            entries.append(entry)
+            size += len(entry)
+            if size >= self.batch_bytes or (batching and
+                                            len(entries) >= self.batch_size):
+                yield self._join_entries(current, entries), len(entries)
+                entries = []
+                size = 0
+        if entries:
+            yield self._join_entries(current, entries), len(entries)
+
+    def _join_entries(self, tag, entries):
+        if self.mode == MESSAGE_MODE:
+            # Message frames follow each other on the stream
+            return b''.join(entries)
+        return self._make_frame(tag, entries)
+
+    def _push_frame(self, frame, events):
+        # messages sent before go first
+        self._flush_batches()
+        self.events += events
+        self._queue_frame(frame)
+        self._flush_queue()
+
+    def _queue_frame(self, frame):
+        if self._wait_until(self._stream_room, self._stream_timeout()):
+            self._enqueue(frame)
+        else:
+            self._shed(frame)
+
+    def _stream_room(self):
+        # keep at most about one frame queued behind the one being written
+        return self._queue_bytes <= self.batch_bytes
+
+    def _stream_timeout(self):
+        if self.overflow == BLOCK and self.block_timeout is not None:
+            return self.block_timeout
+        return self.timeout
+
+    def _shed(self, frame):
+        """Dispose of a frame of send_many which did not fit in time."""
+        spill = self._spill
+        if spill is not None:
+            if not spill.append(frame):
+                self._drop(frame)
+            return
+        if self.overflow != DROP_OLDEST:
+            self._drop(frame)
+            return
+        while len(self._queue) and not self._stream_room():
+            oldest = self._queue.popleft()
+            self._queue_bytes -= len(oldest)
+            self._drop(oldest)
+        self._enqueue(frame)
+
+    def flush(self):
+        self._flush_batches()
+        if self._pending():
+            self._flush_queue(drain=True)
+
+    def _enqueue(self, frame):
+        size = len(frame)
+        spill = self._spill
+        if spill is not None and (len(spill) or self._queue_full(size)):
+            # keep ordering: once spilled, newer frames follow on disk
+            if not spill.append(frame):
+                self._drop(frame)
+            return
+        if self._queue_full(size) and not self._make_room(size):
+            self._drop(frame)
+            return
+        self._queue.append(frame)
+        self._queue_bytes += size
+
+    def _peek(self):
+        try:
+            return self._queue[0]
+        except IndexError:
+            return None
+
+    def _dequeue(self, frame):
+        # the head may have been dropped while the frame was being sent
+        if self._peek() is frame:
+            self._queue.popleft()
+            self._queue_bytes -= len(frame)
+
+    def _drop(self, frame):
+        self.dropped += 1
+        self.dropped_bytes += len(frame)
+
+    def _queue_full(self, size=0):
+        if self.capacity is not None and len(self._queue) >= self.capacity:
+            return True
+        return bool(self.max_queue_bytes is not None and len(self._queue) and
+                    self._queue_bytes + size > self.max_queue_bytes)
+
+    def is_full(self, size=0):
+        """Return True if a frame of ``size`` bytes would overflow."""
+        if not self._queue_full(size):
+            return False
+        spill = self._spill
+        return spill is None or spill.size + size > spill.max_size
+
+    def _make_room(self, size):
+        if not len(self._queue):
+            # capacity is 0: there is nothing to make room from
+            return False
+        if self.overflow == DROP_OLDEST:
+            while self._queue_full(size):
+                frame = self._queue.popleft()
+                self._queue_bytes -= len(frame)
+                self._drop(frame)
+            return True
+        if self.overflow == BLOCK:
+            return self._wait_for_room(size)
+        return False
+
+    def _wait_for_room(self, size):
+        timeout = self.block_timeout
+        if timeout is None:
+            timeout = self.timeout
+        return self._wait_until(lambda: not self._queue_full(size), timeout)
+
+    def _wait_until(self, ready, timeout):
+        """Transmit queued frames until ``ready()`` or ``timeout`` expires."""
+        deadline = time.time() + timeout
+        while not ready():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            # wait for the socket instead of polling it
+            self._flush_queue(drain=True, timeout=remaining)
+            if not ready():
+                # fluentd is down; wait for the next connection attempt
+                time.sleep(max(min(deadline - time.time(),
+                                   self._next_retry() - time.time()), 0))
+        return True
+
+    def _next_retry(self):
+        return self._retry_time
+
+    def _pending(self):
+        return self._pending_frames() or len(self._unacked)
+
+    def _add_entry(self, tag, data, timestamp):
+        self._add_serialized(tag, self.serialize_entry(data, timestamp))
+
+    def _add_serialized(self, tag, entry):
+        if not self._batch_count:
+            self._batch_started = time.time()
+        self._batches.setdefault(tag, []).append(entry)
+        self._batch_count += 1
+        self._batch_bytes += len(entry)
+
+    def _batch_full(self):
+        return (self._batch_count >= self.batch_size or
+                self._batch_bytes >= self.batch_bytes or
+                time.time() - self._batch_started >= self.batch_interval)
+
+    def _flush_batches(self):
+        if not self._batch_count:
+            return
+        for tag, entries in self._batches.items():
+            self._enqueue(self._make_frame(tag, entries))
+        self._reset_batches()
+
+    def _make_message(self, data, tag, timestamp):
+        chunk = new_chunk_id()
+        timestamp = self.clock.timestamp(timestamp)
+        packer = self.packer
+        frame = b''.join([ARRAY4, self.tags.pack(tag or self.tag),
+                          pack_time(packer, timestamp),
+                          pack_record(packer, data),
+                          packer.pack({'chunk': chunk})])
+        return Chunk(frame, chunk)
+
+    def _make_frame(self, tag, entries):
+        packer = self.packer
+        chunk = self.require_ack and new_chunk_id() or None
+        if self.mode == FORWARD_MODE:
+            header = [
+                chunk and ARRAY3 or ARRAY2,
+                self.tags.pack(tag),
+                packer.pack_array_header(len(entries))
+            ]
+            if not chunk:
+                return b''.join(header + entries)
+            frame = b''.join(header + entries +
+                             [packer.pack({'chunk': chunk})])
+            return Chunk(frame, chunk)
+
+        payload = b''.join(entries)
+        option = {'size': len(entries)}
+        if (self.mode == COMPRESSED_PACKED_FORWARD_MODE and
+                len(payload) >= self.compress_min_size):
+            payload = gzip_compress(payload, self.compresslevel)
+            option['compressed'] = 'gzip'
+        if chunk:
+            option['chunk'] = chunk
+        frame = b''.join([
+            ARRAY3,
+            self.tags.pack(tag),
+            pack_bin_header(len(payload)),
+            payload,
+            packer.pack(option)
+        ])
+        return chunk and Chunk(frame, chunk) or frame
+
+    def _flush_queue(self, drain=False, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.time() + timeout
 
         while deadline > time.time():
-            sock = self.socket
+            sock = self._connect(self._blocking_select or drain)
             if not sock:
                 return
 
             try:
+                if self._unacked and self._ack_expired():
+                    self.retried += len(self._unacked)
+                    self._disconnect()
+                    continue
+
+                writing = self._window_open() and self._pending_frames()
+                # wait for acks when they are all we can make progress on
+                waiting = bool(self._unacked) and not writing and (
+                    drain or self._blocking_select or
+                    self._pending_frames())
                 socks = [sock]
-                readable, writeable, _ = select.select(socks, socks, [], 0)
+                wait = 0
+                if self._blocking_select or waiting or drain or \
+                        self._partial is not None:
+                    wait = max(min(deadline, self._ack_deadline()) -
+                               time.time(), 0)
+                readable, writeable, _ = select.select(
+                    socks, writing and socks or [], [], wait)
 
-                if sock in readable and len(sock.recv(1024)) == 0:
-                    self.close()
-                    continue
+                if sock in readable:
+                    data = sock.recv(65536)
+                    if len(data) == 0:
+                        self._disconnect()
+                        continue
+                    self._read_acks(data)
 
                 if sock in writeable:
-                    while len(self._queue):
-                        sock.sendall(self._queue[0])
-                        self._queue.popleft()
+                    self._write(sock)
+                if waiting or (drain and self._pending()) or \
+                        self._partial is not None:
+                    continue
                 return
             except socket.error as e:
                 if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
                     continue
-                self.close()
+                self._disconnect()
+
+    def _pending_frames(self):
+        return (self._partial is not None or len(self._queue) or
+                (self._spill is not None and len(self._spill)))
+
+    def _write(self, sock):
+        """Write as many frames as the socket accepts.
+
+        Frames are gathered into a single ``sendmsg`` call. A frame which
+        was written partially is moved out of the queue, so that it can not
+        be dropped, and the rest of it is written first on the next call.
+        """
+        while self._window_open():
+            frames, spilled = self._gather()
+            if not frames:
+                return
+            partial = self._partial
+            views = [memoryview(frame) for frame in frames]
+            if partial is not None:
+                views[0] = views[0][self._partial_offset:]
+            sent = send_buffers(sock, views)
+            for i, frame in enumerate(frames):
+                if sent <= 0:
+                    return
+                if i or partial is None:
+                    self._remove(frame, spilled)
+                if sent < len(views[i]):
+                    self._partial = frame
+                    self._partial_offset = len(frame) - len(views[i]) + sent
+                    return
+                sent -= len(views[i])
+                self._partial = None
+                self.frames_sent += 1
+                self.bytes_sent += len(frame)
+                self._track(frame)
+
+    def _gather(self):
+        limit = MAX_IOV
+        if self.require_ack:
+            limit = min(limit, self.ack_window - len(self._unacked))
+        frames = []
+        if self._partial is not None:
+            frames.append(self._partial)
+        frames.extend(islice(self._queue, limit - len(frames)))
+        if frames or self._spill is None:
+            return frames, False
+        frame = self._spill.peek()
+        return frame is not None and [frame] or [], True
+
+    def _remove(self, frame, spilled):
+        if spilled:
+            self._spill.pop()
+        else:
+            self._dequeue(frame)
+
+    def _window_open(self):
+        return not self.require_ack or len(self._unacked) < self.ack_window
+
+    def _track(self, frame):
+        if not self.require_ack:
+            return
+        chunk = getattr(frame, 'chunk', None)
+        if chunk is None:
+            # frames read back from the spill buffer lost their attribute
+            option = msgpack.unpackb(frame, encoding='utf-8')[-1]
+            if not isinstance(option, dict) or 'chunk' not in option:
+                return
+            chunk = option['chunk']
+            frame = Chunk(frame, chunk)
+        self._unacked[chunk] = (frame, time.time() + self.ack_timeout)
+
+    def _ack_deadline(self):
+        for frame, deadline in self._unacked.values():
+            return deadline
+        return float('inf')
+
+    def _ack_expired(self):
+        return self._ack_deadline() <= time.time()
+
+    def _read_acks(self, data):
+        self._unpacker.feed(data)
+        for response in self._unpacker:
+            if isinstance(response, dict) and \
+                    self._unacked.pop(response.get('ack'), None):
+                self.acked += 1
+
+    def _requeue_unacked(self):
+        frames = [frame for frame, deadline in self._unacked.values()]
+        self._unacked.clear()
+        self._requeue(frames)
+
+    def _requeue(self, frames):
+        """Put ``frames`` back at the head of the queue, in order.
+
+        When ``capacity`` is reached, the newest frames of the queue are
+        dropped to make room, so the oldest frames are sent first.
+        """
+        queue = self._queue
+        for frame in reversed(frames):
+            if self.capacity is not None and len(queue) >= self.capacity:
+                if not len(queue):
+                    self._drop(frame)
+                    continue
+                newest = queue.pop()
+                self._queue_bytes -= len(newest)
+                self._drop(newest)
+            queue.appendleft(frame)
+            self._queue_bytes += len(frame)
+
+    def stats(self):
+        """Return a snapshot of the counters of this sender."""
+        return {
+            'events': self.events,
+            'frames_sent': self.frames_sent,
+            'bytes_sent': self.bytes_sent,
+            'queue_length': len(self._queue),
+            'queue_bytes': self._queue_bytes,
+            'batch_length': self._batch_count,
+            'spill_length': self._spill is not None and len(self._spill) or 0,
+            'dropped': self.dropped,
+            'dropped_bytes': self.dropped_bytes,
+            'connects': self.connects,
+            'connect_failures': self.connect_failures,
+            'connected': self._sock is not None,
+            'acked': self.acked,
+            'retried': self.retried,
+            'unacked': len(self._unacked),
+            'suppressed': (self.rate_limiter is not None and
+                           self.rate_limiter.suppressed or 0),
+            'send_latency': self.send_latency.snapshot()
+        }
+
+    def _report(self, now):
+        if self.stats_tag and now >= self._next_report:
+            self._next_report = now + self.stats_interval
+            self._append(self.stats(), self.stats_tag, now)
+        limiter = self.rate_limiter
+        if limiter is not None:
+            summary = limiter.summary(now)
+            if summary is not None:
+                self._append(summary, limiter.summary_tag, now)
 
     def serialize(self, data, tag=None, timestamp=None):
-        timestamp = timestamp or time.time()
+        timestamp = self.clock.timestamp(timestamp)
         tag = tag or self.tag
-        data = ensure_dict(data)
-        return self.packer.pack([tag, timestamp, data])
+        packer = self.packer
+        return b''.join([ARRAY3, self.tags.pack(tag),
+                         pack_time(packer, timestamp),
+                         pack_record(packer, data)])
+
+    def serialize_entry(self, data, timestamp=None):
+        timestamp = self.clock.timestamp(timestamp)
+        packer = self.packer
+        return b''.join([ARRAY2, pack_time(packer, timestamp),
+                         pack_record(packer, data)])
 
     def close(self):
+        self.flush()
+        self._disconnect()
+        if self._spill is not None:
+            self._spill.close()
+
+    def _disconnect(self):
         self._reset_retry()
         if self._sock:
             self._sock.close()
             self._sock = None
+        if self._connecting is not None:
+            self._connecting.close()
+            self._connecting = None
+        if self._partial is not None:
+            # a new connection starts a new stream; send the frame whole
+            self._requeue([self._partial])
+            self._partial = None
+        if self._unacked:
+            # unacknowledged frames are retransmitted on the next connection
+            self._requeue_unacked()
+        self._unpacker = msgpack.Unpacker(encoding='utf-8')
+
+
+class AsyncFluentSender(FluentSender):
+    """FluentSender which transmits messages from a background thread.
+
+    ``send`` only serializes a message, with a Packer owned by the calling
+    thread, and appends it to a buffer owned by the calling thread as well,
+    so threads sending concurrently do not contend on a lock. The socket,
+    reconnection, batching and flushing are owned by a daemon thread which
+    merges the buffers of all threads, so the caller never waits for
+    fluentd.
+    """
+
+    _blocking_select = True
+    thread_safe = True
+
+    def __init__(self, *args, **kwargs):
+        self._local = threading.local()
+        FluentSender.__init__(self, *args, **kwargs)
+        self._cond = threading.Condition()
+        self._buffers = []
+        self._flush_requested = False
+        self._closing = False
+        self._close_deadline = 0
+        self._thread = None
+
+    @property
+    def packer(self):
+        try:
+            return self._local.packer
+        except AttributeError:
+            packer = self._local.packer = make_packer(self.encoders)
+            return packer
+
+    @packer.setter
+    def packer(self, packer):
+        self._local.packer = packer
+
+    @property
+    def tags(self):
+        try:
+            return self._local.tags
+        except AttributeError:
+            tags = self._local.tags = TagCache()
+            return tags
+
+    @tags.setter
+    def tags(self, tags):
+        self._local.tags = tags
+
+    def _ensure_thread(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._closing = False
+        self._thread = threading.Thread(target=self._run,
+                                        name='pyfluent-sender')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def send(self, data, tag=None, timestamp=None):
+        start = time.time()
+        if CHECK_PID and self._pid != os.getpid():
+            self._after_fork()
+        if not self._allow(tag, start):
+            return
+        if self.mode != MESSAGE_MODE:
+            item = (tag or self.tag, self.serialize_entry(data, timestamp))
+        elif self.require_ack:
+            item = (None, self._make_message(data, tag, timestamp))
+        else:
+            item = (None, self.serialize(data, tag, timestamp))
+        if self.overflow == BLOCK and self._queue_full(len(item[1])):
+            if not self._block(len(item[1])):
+                self.events += 1
+                self._drop(item[1])
+                return
+        buffer = self._buffer()
+        buffer.append(item)
+        if len(buffer) == 1:
+            # the flusher empties buffers before it sleeps
+            self._wake()
+        self.send_latency.observe(time.time() - start)
+
+    def _buffer(self):
+        try:
+            return self._local.buffer
+        except AttributeError:
+            pass
+        buffer = self._local.buffer = deque()
+        self._cond.acquire()
+        try:
+            self._buffers.append((threading.current_thread(), buffer))
+        finally:
+            self._cond.release()
+        return buffer
+
+    def _wake(self):
+        self._cond.acquire()
+        try:
+            self._ensure_thread()
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def _block(self, size):
+        self._cond.acquire()
+        try:
+            self._ensure_thread()
+            return self._wait_for_room(size)
+        finally:
+            self._cond.release()
+
+    def _buffered(self):
+        for thread, buffer in self._buffers:
+            if buffer:
+                return True
+        return False
+
+    def _can_merge(self):
+        # with BLOCK, messages wait in the buffers until the queue has room
+        return self.overflow != BLOCK or not self._queue_full()
+
+    def _merge_buffers(self):
+        # called by the flusher with the lock held
+        self._report(time.time())
+        for thread, buffer in list(self._buffers):
+            while self._can_merge():
+                try:
+                    tag, item = buffer.popleft()
+                except IndexError:
+                    break
+                self.events += 1
+                if tag is None:
+                    self._enqueue(item)
+                    continue
+                self._add_serialized(tag, item)
+                if self._batch_full():
+                    self._flush_batches()
+            if not thread.is_alive() and not buffer:
+                self._buffers.remove((thread, buffer))
+
+    def send_raw(self, frame):
+        self._cond.acquire()
+        try:
+            self._ensure_thread()
+            self._enqueue(frame)
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def _push_frame(self, frame, events):
+        self._cond.acquire()
+        try:
+            self._ensure_thread()
+            # messages sent before go first
+            self._merge_buffers()
+            self._flush_batches()
+            self.events += events
+            self._queue_frame(frame)
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def _after_fork(self):
+        # the lock may have been held by a thread which does not exist here
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        self._buffers = []
+        self._thread = None
+        self._flush_requested = False
+        self._closing = False
+        FluentSender._after_fork(self)
+
+    def _dequeue(self, frame):
+        self._cond.acquire()
+        try:
+            FluentSender._dequeue(self, frame)
+        finally:
+            self._cond.release()
+
+    def _disconnect(self):
+        self._cond.acquire()
+        try:
+            FluentSender._disconnect(self)
+        finally:
+            self._cond.release()
+
+    def _gather(self):
+        # senders append to the queue while it is iterated
+        self._cond.acquire()
+        try:
+            return FluentSender._gather(self)
+        finally:
+            self._cond.release()
+
+    def _wait_for_room(self, size):
+        if threading.current_thread() is self._thread:
+            # never wait for ourselves; batches already accepted are kept
+            return True
+        return FluentSender._wait_for_room(self, size)
+
+    def _wait_until(self, ready, timeout):
+        # called with the lock held; the flusher transmits the queue
+        deadline = time.time() + timeout
+        while not ready():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            self._cond.notify()
+            self._cond.wait(remaining)
+        return True
+
+    def flush(self, timeout=None):
+        """Wait until all queued messages are transmitted.
+
+        Returns False if they could not be transmitted within ``timeout``
+        seconds (defaults to ``self.timeout``).
+        """
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.time() + timeout
+        self._cond.acquire()
+        try:
+            if not self._thread or not self._thread.is_alive():
+                return not (self._pending() or self._batch_count or
+                            self._buffered())
+            self._flush_requested = True
+            self._cond.notify_all()
+            while self._pending() or self._batch_count or self._buffered():
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+        finally:
+            self._flush_requested = False
+            self._cond.release()
+
+    def close(self, timeout=None):
+        """Flush queued messages and stop the background thread.
+
+        Messages which could not be transmitted within ``timeout`` seconds
+        (defaults to ``self.timeout``) are kept in the queue.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        self._cond.acquire()
+        try:
+            thread = self._thread
+            self._closing = True
+            self._close_deadline = time.time() + timeout
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+        if thread:
+            thread.join(timeout)
+        else:
+            self._disconnect()
+        if self._spill is not None:
+            self._spill.close()
+
+    def _close_expired(self):
+        # nothing can be sent before the deadline once reconnecting is later
+        return self._close_deadline <= time.time() or (
+            self._sock is None and self._retry_time >= self._close_deadline)
+
+    def _delay(self):
+        if self._closing and self._close_expired():
+            return 0
+        if self._buffered() and self._can_merge():
+            return 0
+        now = time.time()
+        delays = []
+        if self._pending():
+            if self._sock or self._retry_time <= now:
+                return 0
+            delays.append(self._retry_time - now)
+        if self._batch_count:
+            if self._closing or self._flush_requested:
+                return 0
+            delays.append(self._batch_started + self.batch_interval - now)
+        if self._closing:
+            if not delays:
+                return 0
+            delays.append(self._close_deadline - now)
+        if not delays:
+            return None
+        return max(min(delays), 0)
+
+    def _run(self):
+        cond = self._cond
+        while True:
+            cond.acquire()
+            try:
+                self._merge_buffers()
+                delay = self._delay()
+                while delay != 0:
+                    cond.wait(delay)
+                    self._merge_buffers()
+                    delay = self._delay()
+                if self._batch_count and (self._closing or
+                                          self._flush_requested or
+                                          self._batch_full()):
+                    self._flush_batches()
+                closing = self._closing
+            finally:
+                cond.release()
+
+            if self._pending():
+                self._flush_queue()
+
+            cond.acquire()
+            try:
+                cond.notify_all()
+                if closing and (not (self._pending() or self._buffered()) or
+                                self._close_expired()):
+                    self._disconnect()
+                    return
+            finally:
+                cond.release()
+
+
+class FluentClusterSender(FluentSender):
+    """FluentSender which balances messages over several fluentd servers.
+
+    ``servers`` is a list of ``(host, port)`` or ``(host, port, weight)``.
+    Each server has its own connection and reconnection backoff. Frames are
+    assigned by weighted round robin or to the server with the least pending
+    bytes, and frames queued for a server which failed are moved back and
+    reassigned to the healthy ones. A server is handed at most about
+    ``batch_bytes`` at a time; the other frames wait in the queue of the
+    cluster, where ``capacity``, ``max_queue_bytes`` and ``overflow`` apply.
+    """
+
+    def __init__(self, servers, tag='', timeout=1, capacity=None,
+                 balance=ROUND_ROBIN, **kwargs):
+        FluentSender.__init__(self, None, None, tag, timeout, capacity,
+                              **kwargs)
+        self.balance = balance
+        self.endpoints = []
+        for server in servers:
+            host, port, weight = (tuple(server) + (1, ))[:3]
+            endpoint = FluentSender(host, port, tag, timeout,
+                                    require_ack=self.require_ack,
+                                    ack_timeout=self.ack_timeout,
+                                    ack_window=self.ack_window)
+            endpoint.weight = weight
+            endpoint.current_weight = 0
+            self.endpoints.append(endpoint)
+
+    def _healthy(self, endpoint, now):
+        return endpoint._sock is not None or endpoint._retry_time <= now
+
+    def _choose(self, endpoints):
+        if self.balance == LEAST_PENDING:
+            return min(endpoints,
+                       key=lambda e: (e._queue_bytes, -e.weight))
+        # smooth weighted round robin
+        total = 0
+        best = None
+        for endpoint in endpoints:
+            endpoint.current_weight += endpoint.weight
+            total += endpoint.weight
+            if best is None or endpoint.current_weight > best.current_weight:
+                best = endpoint
+        best.current_weight -= total
+        return best
+
+    def _take(self):
+        frame = self._peek()
+        if frame is not None:
+            self._queue.popleft()
+            self._queue_bytes -= len(frame)
+        elif self._spill is not None:
+            frame = self._spill.peek()
+            if frame is not None:
+                self._spill.pop()
+        return frame
+
+    def _failover(self, endpoint):
+        frames = list(endpoint._queue)
+        endpoint._queue.clear()
+        endpoint._queue_bytes = 0
+        self._requeue(frames)
+
+    def _has_room(self, endpoint):
+        # frames beyond one batch wait in the bounded queue of the cluster
+        return endpoint._queue_bytes < self.batch_bytes
+
+    def _assign(self):
+        now = time.time()
+        healthy = []
+        for endpoint in self.endpoints:
+            if self._healthy(endpoint, now):
+                healthy.append(endpoint)
+            elif len(endpoint._queue):
+                self._failover(endpoint)
+        while True:
+            endpoints = [e for e in healthy if self._has_room(e)]
+            if not endpoints:
+                break
+            frame = self._take()
+            if frame is None:
+                break
+            self._choose(endpoints)._enqueue(frame)
+        return healthy
+
+    def _flush_queue(self, drain=False, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.time() + timeout
+        while True:
+            healthy = self._assign()
+            for endpoint in healthy:
+                if endpoint._pending():
+                    endpoint._flush_queue(
+                        drain, max(deadline - time.time(), 0))
+            if not (drain and healthy and
+                    FluentSender._pending_frames(self)):
+                return
+            if time.time() >= deadline:
+                return
+
+    def _pending(self):
+        if FluentSender._pending(self):
+            return True
+        for endpoint in self.endpoints:
+            if endpoint._pending():
+                return True
+        return False
+
+    def stats(self):
+        stats = FluentSender.stats(self)
+        now = time.time()
+        stats['endpoints'] = [{
+            'host': e.host,
+            'port': e.port,
+            'healthy': self._healthy(e, now),
+            'queue_length': len(e._queue),
+            'queue_bytes': e._queue_bytes,
+            'frames_sent': e.frames_sent,
+            'bytes_sent': e.bytes_sent,
+            'connects': e.connects,
+            'connect_failures': e.connect_failures,
+            'acked': e.acked,
+            'retried': e.retried,
+            'unacked': len(e._unacked)
+        } for e in self.endpoints]
+        for key in ('frames_sent', 'bytes_sent', 'connects',
+                    'connect_failures', 'acked', 'retried', 'unacked'):
+            stats[key] = sum(x[key] for x in stats['endpoints'])
+        stats['connected'] = any(e._sock is not None for e in self.endpoints)
+        return stats
+
+    def _next_retry(self):
+        return min(e._retry_time for e in self.endpoints)
+
+    def _after_fork(self):
+        FluentSender._after_fork(self)
+        for endpoint in self.endpoints:
+            endpoint._after_fork()
+
+    def close(self):
+        FluentSender.close(self)
+        for endpoint in self.endpoints:
+            endpoint._disconnect()
+
+
+def _after_fork_in_child():
+    FluentSender.resolver._after_fork()
+    for sender in list(_senders):
+        sender._after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+class TagCache(object):
+    """Bounded LRU cache of tags packed by msgpack.
+
+    Tags come from a small set, so frames are assembled from the cached
+    bytes instead of packing the tag for every message. Not thread safe.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._packed = OrderedDict()
+        self._packer = msgpack.Packer(encoding='utf-8')
+
+    def pack(self, tag):
+        packed = self._packed.pop(tag, None)
+        if packed is None:
+            packed = self._packer.pack(tag)
+            if len(self._packed) >= self.maxsize:
+                self._packed.popitem(last=False)
+        # most recently used last
+        self._packed[tag] = packed
+        return packed
+
+    def __len__(self):
+        return len(self._packed)
+
+
+class Chunk(bytes):
+    """Serialized frame which carries the chunk id to be acknowledged."""
+
+    def __new__(cls, frame, chunk):
+        self = bytes.__new__(cls, frame)
+        self.chunk = chunk
+        return self
+
+
+def new_chunk_id():
+    return base64.b64encode(os.urandom(16)).decode('ascii')
+
+
+def unix_path(host):
+    """Return the socket path of a ``unix://`` host, or None.
+
+    ``unix://@name`` refers to ``name`` in the abstract namespace.
+    """
+    if not host or not host.startswith(UNIX_SCHEME):
+        return None
+    path = host[len(UNIX_SCHEME):]
+    if path.startswith('@'):
+        return '\0' + path[1:]
+    return path
 
 
 def ensure_dict(data):
@@ -118,6 +1322,56 @@ def ensure_dict(data):
     return {'message': data}
 
 
+class PackedRecord(bytes):
+    """Record which is already packed by msgpack; it is sent as is."""
+
+
+def pack_record(packer, data):
+    cls = type(data)
+    if cls is dict:
+        return packer.pack(data)
+    if cls is PackedRecord:
+        return data
+    return packer.pack(ensure_dict(data))
+
+
+def send_buffers(sock, buffers):
+    """Write ``buffers`` with one system call and return the bytes sent."""
+    if hasattr(sock, 'sendmsg'):
+        return sock.sendmsg(buffers)
+    # Python 2 and Windows have no sendmsg
+    return sock.send(buffers[0])
+
+
+def make_packer(encoders=None):
+    """Return a Packer encoding unknown types by ``encoders``."""
+    if encoders is None:
+        encoders = encoder.registry
+    return msgpack.Packer(encoding='utf-8', default=encoders)
+
+
+def pack_time(packer, timestamp):
+    cls = type(timestamp)
+    if cls is float:
+        return _pack_float(0xcb, timestamp)
+    if cls is EventTime:
+        return timestamp.packed
+    return packer.pack(timestamp)
+
+
+def pack_bin_header(length):
+    if length < 0x100:
+        return struct.pack('>BB', 0xc4, length)
+    if length < 0x10000:
+        return struct.pack('>BH', 0xc5, length)
+    return struct.pack('>BI', 0xc6, length)
+
+
+def gzip_compress(data, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
 def geometric_sequence(start=1.0, factor=2.0, limit=30.0):
     num = start
     while num < limit:
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Yoshihisa Tanaka
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import struct
+import time
+
+import msgpack
+
+try:
+    time_ns = time.time_ns
+except AttributeError:
+    # Python < 3.7
+    def time_ns():
+        return int(time.time() * 1e9)
+
+# fixext 8 of type 0, seconds and nanoseconds
+_pack_event_time = struct.Struct('>BbII').pack
+
+
+class EventTime(object):
+    """Timestamp with nanosecond precision.
+
+    It is packed as the EventTime extension type of the forward protocol
+    instead of a float. The packed form is cached, so a timestamp shared by
+    many events is packed only once.
+    """
+
+    __slots__ = ('seconds', 'nanoseconds', '_packed')
+
+    def __init__(self, seconds, nanoseconds=0):
+        self.seconds = seconds
+        self.nanoseconds = nanoseconds
+        self._packed = None
+
+    @classmethod
+    def from_ns(cls, ns):
+        return cls(ns // 1000000000, ns % 1000000000)
+
+    @classmethod
+    def from_float(cls, timestamp):
+        seconds = int(timestamp)
+        # the fraction may round up to a whole second
+        return cls.from_ns(seconds * 1000000000 +
+                           int(round((timestamp - seconds) * 1e9)))
+
+    @property
+    def packed(self):
+        if self._packed is None:
+            self._packed = _pack_event_time(0xd7, 0, self.seconds,
+                                            self.nanoseconds)
+        return self._packed
+
+    def to_ext(self):
+        return msgpack.ExtType(0, self.packed[2:])
+
+    def __float__(self):
+        return self.seconds + self.nanoseconds / 1e9
+
+    def __eq__(self, other):
+        return (isinstance(other, EventTime) and
+                self.seconds == other.seconds and
+                self.nanoseconds == other.nanoseconds)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.seconds, self.nanoseconds))
+
+    def __repr__(self):
+        return 'EventTime(%d, %d)' % (self.seconds, self.nanoseconds)
+
+
+class Clock(object):
+    """Source of the timestamps of events.
+
+    By default timestamps are floats from ``time.time()``. With
+    ``nanosecond_precision`` they are EventTime from ``time_ns()``. With
+    ``resolution`` (in seconds), timestamps are truncated to a multiple of
+    it and the same timestamp object is reused within each tick, which
+    saves converting and packing a timestamp per event when per-event
+    precision is not needed.
+    """
+
+    def __init__(self, nanosecond_precision=False, resolution=None):
+        self.nanosecond_precision = nanosecond_precision
+        self.resolution = resolution
+        self._resolution_ns = resolution and int(resolution * 1e9) or 0
+        self._plain = not (nanosecond_precision or resolution)
+        # (tick, timestamp) of the coarse clock
+        self._cached = (None, None)
+
+    def now(self):
+        if self._plain:
+            return time.time()
+        return self._from_ns(time_ns())
+
+    def timestamp(self, timestamp=None):
+        """Return ``timestamp`` converted for this clock, or the time now."""
+        if not timestamp:
+            return self.now()
+        if self._plain or type(timestamp) is EventTime:
+            return timestamp
+        seconds = int(timestamp)
+        return self._from_ns(seconds * 1000000000 +
+                             int(round((timestamp - seconds) * 1e9)))
+
+    def _from_ns(self, ns):
+        resolution = self._resolution_ns
+        if not resolution:
+            return self._make(ns)
+        tick = ns // resolution
+        cached = self._cached
+        if cached[0] == tick:
+            return cached[1]
+        timestamp = self._make(tick * resolution)
+        self._cached = (tick, timestamp)
+        return timestamp
+
+    def _make(self, ns):
+        if self.nanosecond_precision:
+            return EventTime.from_ns(ns)
+        return ns / 1e9
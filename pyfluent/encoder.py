@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Yoshihisa Tanaka
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import decimal
+import traceback
+import uuid
+
+from pyfluent.clock import EventTime
+
+
+class EncoderRegistry(object):
+    """Encoders of the types which msgpack cannot pack, by type.
+
+    A registry is passed as ``default`` to msgpack.Packer, so it is called
+    only for objects msgpack does not know and plain records are packed
+    as before. The encoder of a type is the one registered for the nearest
+    class in its MRO; it is looked up once per type and cached. Objects
+    without an encoder are packed as their ``repr``.
+    """
+
+    max_cache = 1024
+
+    def __init__(self, fallback=repr):
+        self.fallback = fallback
+        self._encoders = {}
+        self._cache = {}
+
+    def register(self, cls, encoder):
+        """Encode instances of ``cls`` and its subclasses by ``encoder``.
+
+        ``encoder`` returns an object msgpack can pack.
+        """
+        self._encoders[cls] = encoder
+        self._cache = {}
+
+    def unregister(self, cls):
+        del self._encoders[cls]
+        self._cache = {}
+
+    def copy(self):
+        registry = EncoderRegistry(self.fallback)
+        registry._encoders = dict(self._encoders)
+        return registry
+
+    def __call__(self, obj):
+        cls = type(obj)
+        encoder = self._cache.get(cls)
+        if encoder is None:
+            encoder = self._resolve(cls)
+        return encoder(obj)
+
+    def _resolve(self, cls):
+        encoder = self.fallback
+        for base in getattr(cls, '__mro__', (cls, )):
+            if base in self._encoders:
+                encoder = self._encoders[base]
+                break
+        cache = self._cache
+        if len(cache) >= self.max_cache:
+            cache.clear()
+        cache[cls] = encoder
+        return encoder
+
+
+def isoformat(value):
+    return value.isoformat()
+
+
+def format_exception(value):
+    return traceback.format_exception_only(type(value), value)[-1].rstrip()
+
+
+# used by senders and handlers unless they are given their own
+registry = EncoderRegistry()
+registry.register(datetime.date, isoformat)
+registry.register(datetime.time, isoformat)
+registry.register(datetime.timedelta, datetime.timedelta.total_seconds)
+registry.register(decimal.Decimal, str)
+registry.register(uuid.UUID, str)
+registry.register(set, list)
+registry.register(frozenset, list)
+registry.register(BaseException, format_exception)
+registry.register(EventTime, EventTime.to_ext)
+register = registry.register
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Yoshihisa Tanaka
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import multiprocessing
+import os
+import select
+import socket
+
+import msgpack
+
+from pyfluent.client import AsyncFluentSender, UNIX_SCHEME
+
+
+class Forwarder(object):
+    """Process relaying the frames of local workers to fluentd.
+
+    The forwarder listens on the Unix domain socket ``path`` and speaks the
+    forward protocol, so workers simply use
+    ``FluentSender('unix://' + path)``. Received frames are relayed as they
+    are through a single AsyncFluentSender, created with ``host``, ``port``
+    and the other keyword arguments, so fluentd sees one connection per
+    host instead of one per worker.
+
+    Frames carrying a ``chunk`` option are acknowledged once they are queued
+    by the forwarder. Start the forwarder before forking the workers, e.g.
+    in the ``on_starting`` hook of gunicorn.
+    """
+
+    def __init__(self, path, host='localhost', port=24224, **kwargs):
+        self.path = path
+        self.host = host
+        self.port = port
+        self.kwargs = kwargs
+        self._process = None
+        self._stop = None
+
+    @property
+    def address(self):
+        """The host to pass to the senders of the workers."""
+        return UNIX_SCHEME + self.path
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.path)
+        listener.listen(128)
+        context = multiprocessing
+        if hasattr(multiprocessing, 'get_context'):
+            context = multiprocessing.get_context('fork')
+        self._stop = context.Event()
+        self._process = context.Process(target=self.serve, args=(listener, ),
+                                        name='pyfluent-forwarder')
+        self._process.daemon = True
+        self._process.start()
+        # workers can connect as soon as start returns
+        listener.close()
+        return self
+
+    def stop(self, timeout=None):
+        """Stop the forwarder after flushing its queue."""
+        if self._process:
+            self._stop.set()
+            self._process.join(timeout)
+            self._process = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def serve(self, listener):
+        sender = AsyncFluentSender(self.host, self.port, **self.kwargs)
+        connections = {}
+        try:
+            while not self._stop.is_set():
+                socks = [listener] + list(connections)
+                readable = select.select(socks, [], [], 0.1)[0]
+                for sock in readable:
+                    if sock is listener:
+                        conn = listener.accept()[0]
+                        conn.settimeout(sender.timeout)
+                        connections[conn] = Connection(conn)
+                    elif not connections[sock].relay(sender):
+                        sock.close()
+                        del connections[sock]
+        finally:
+            listener.close()
+            for sock in connections:
+                sock.close()
+            sender.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class Connection(object):
+    """Splits the stream of a worker into frames without serializing them.
+
+    Frames are decoded only to find where they end and whether they need an
+    acknowledgement; the received bytes are relayed as they are.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.unpacker = msgpack.Unpacker(encoding='utf-8')
+        self.buffer = bytearray()
+        self.offset = 0
+
+    def relay(self, sender):
+        """Relay the frames received so far. Returns False on EOF."""
+        try:
+            data = self.sock.recv(65536)
+        except socket.error:
+            return False
+        if not data:
+            return False
+        self.buffer.extend(data)
+        self.unpacker.feed(data)
+        start = 0
+        acks = []
+        for obj in self.unpacker:
+            end = self.unpacker.tell() - self.offset
+            sender.send_raw(bytes(self.buffer[start:end]))
+            start = end
+            chunk = frame_chunk(obj)
+            if chunk is not None:
+                acks.append(msgpack.packb({'ack': chunk}))
+        del self.buffer[:start]
+        self.offset += start
+        if acks:
+            try:
+                self.sock.sendall(b''.join(acks))
+            except socket.error:
+                return False
+        return True
+
+
+def frame_chunk(obj):
+    """Return the chunk id of a decoded frame, or None."""
+    if not isinstance(obj, (list, tuple)):
+        return None
+    if len(obj) == 4:
+        option = obj[3]
+    elif len(obj) == 3 and isinstance(obj[1], (list, tuple, bytes)):
+        option = obj[2]
+    else:
+        return None
+    if isinstance(option, dict):
+        return option.get('chunk')
+    return None
@@ -17,54 +17,460 @@ from __future__ import absolute_import
 
 import logging
 import logging.handlers
+import os
 import socket
+import threading
+import time
+import traceback
+from collections import OrderedDict, deque
 
-import msgpack
+from pyfluent.client import (ARRAY3, CHECK_PID, FORWARD_MODE,
+                             AsyncFluentSender, FluentSender, TagCache,
+                             WeakSet, ensure_dict, make_packer, pack_time,
+                             unix_path)
+from pyfluent.clock import Clock
+from pyfluent.tracebacks import TracebackCache
 
-from pyfluent.client import FluentSender, ensure_dict
+# (tag, levelname) -> tag of the records
+_level_tags = {}
+MAX_LEVEL_TAGS = 1024
+
+# batching handlers of this process, reset in the child after os.fork
+_handlers = None
+if WeakSet is not None:
+    _handlers = WeakSet()
+
+
+def level_tag(tag, levelname):
+    """Return ``tag`` followed by the lowercased ``levelname``."""
+    key = (tag, levelname)
+    result = _level_tags.get(key)
+    if result is None:
+        if len(_level_tags) >= MAX_LEVEL_TAGS:
+            _level_tags.clear()
+        result = ('%s.%s' % (tag, levelname.lower())).lstrip('.')
+        _level_tags[key] = result
+    return result
 
 
 class FluentHandler(logging.handlers.SocketHandler):
-    def __init__(self, host='localhost', port=24224, tag=''):
+    def __init__(self, host='localhost', port=24224, tag='',
+                 nanosecond_precision=False, clock_resolution=None,
+                 encoders=None):
         logging.handlers.SocketHandler.__init__(self, host, port)
         self.tag = tag
+        self.clock = Clock(nanosecond_precision, clock_resolution)
         self.closeOnError = 1
-        self.packer = msgpack.Packer(encoding='utf-8')
+        self.packer = make_packer(encoders)
+        self.tags = TagCache()
+
+    def makeSocket(self, timeout=1):
+        path = unix_path(self.host)
+        if path is None:
+            return logging.handlers.SocketHandler.makeSocket(self, timeout)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(path)
+        except socket.error:
+            sock.close()
+            raise
+        return sock
 
     def makePickle(self, record):
         return self.serialize(record)
 
     def serialize(self, record):
         result = ensure_dict(self.format(record))
-        tag = ('%s.%s' % (self.tag, record.levelname.lower())).lstrip('.')
-        return self.packer.pack([tag, record.created, result])
+        tag = level_tag(self.tag, record.levelname)
+        timestamp = self.clock.timestamp(record.created)
+        packer = self.packer
+        return b''.join([ARRAY3, self.tags.pack(tag),
+                         pack_time(packer, timestamp),
+                         packer.pack(result)])
 
 
 class SafeFluentHandler(logging.Handler):
     def __init__(self, host='localhost', port=24224, tag='',
-                 timeout=1, capacity=None):
+                 timeout=1, capacity=None, async_send=False,
+                 overflow_level=None, rate_limiter=None,
+                 aggregate_window=None, **kwargs):
         logging.Handler.__init__(self)
         self.tag = tag
-        self.fluent = FluentSender(host, port, tag, timeout, capacity)
+        self.overflow_level = overflow_level
+        # checked here, before the record is formatted
+        self.rate_limiter = rate_limiter
+        self.aggregator = None
+        if aggregate_window:
+            self.aggregator = RecordAggregator(aggregate_window)
+        self.dropped = 0
+        sender_class = async_send and AsyncFluentSender or FluentSender
+        self.fluent = sender_class(host, port, tag, timeout, capacity,
+                                   **kwargs)
+
+    def handle(self, record):
+        if not self.fluent.thread_safe:
+            return logging.Handler.handle(self, record)
+        # the sender serializes per thread; skip the handler lock
+        rv = self.filter(record)
+        if rv:
+            self.emit(record)
+        return rv
 
     def emit(self, record):
+        if (self.overflow_level is not None and
+                record.levelno < self.overflow_level and
+                self.fluent.is_full()):
+            self.dropped += 1
+            return
         try:
+            if self.aggregator is not None:
+                emit, closed = self.aggregator.add(record)
+                for window in closed:
+                    self._emit_repeated(window)
+                if not emit:
+                    return
+            tag = level_tag(self.tag, record.levelname)
+            if self.rate_limiter is not None and not self._allow(tag):
+                return
             data = self.format(record)
-            tag = ('%s.%s' % (self.tag, record.levelname.lower())).lstrip('.')
             self.fluent.send(data, tag, record.created)
         except (KeyboardInterrupt, SystemExit):
             raise
         except:
             self.handleError(record)
 
+    def format(self, record):
+        formatter = self.formatter or _default_formatter
+        return formatter.format(record)
+
+    def _allow(self, tag):
+        limiter = self.rate_limiter
+        now = time.time()
+        summary = limiter.summary(now)
+        if summary is not None:
+            self.fluent.send(summary, limiter.summary_tag, now)
+        return limiter.allow(tag, now)
+
+    def _emit_repeated(self, window):
+        record = window.record
+        data = ensure_dict(self.format(record))
+        data['count'] = window.count
+        data['first_time'] = window.first
+        data['last_time'] = window.last
+        self.fluent.send(data, level_tag(self.tag, record.levelname),
+                         window.first)
+
+    def flush(self):
+        """Emit the repeated records of all windows."""
+        if self.aggregator is None:
+            return
+        self._emit_closed(self.aggregator.expire(None))
+
+    def _emit_closed(self, windows):
+        for window in windows:
+            try:
+                self._emit_repeated(window)
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                self.handleError(window.record)
+
     def close(self):
+        self.flush()
         self.fluent.close()
         logging.Handler.close(self)
 
 
-class FluentFormatter(logging.Formatter):
-    def __init__(self, fmt=None, datefmt=None):
+class BatchingFluentHandler(SafeFluentHandler):
+    """SafeFluentHandler which formats and sends records on a worker thread.
+
+    Logging calls only append the record to a queue. The worker formats the
+    queued records and sends them every ``flush_interval`` seconds, as soon
+    as ``batch_size`` records are queued, or as soon as a record of
+    ``flush_level`` or above is queued. Records beyond ``queue_size`` are
+    counted in ``dropped``. As records are formatted later, their arguments
+    should not be modified after the logging call.
+    """
+
+    def __init__(self, host='localhost', port=24224, tag='', timeout=1,
+                 capacity=None, flush_level=logging.ERROR, flush_interval=1.0,
+                 batch_size=1000, queue_size=10000, mode=FORWARD_MODE,
+                 **kwargs):
+        SafeFluentHandler.__init__(self, host, port, tag, timeout, capacity,
+                                   mode=mode, batch_size=batch_size,
+                                   batch_interval=flush_interval, **kwargs)
+        self.flush_level = flush_level
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self._after_fork()
+        if _handlers is not None:
+            _handlers.add(self)
+
+    def _after_fork(self):
+        # records queued before the fork are sent by the parent
+        self._pid = os.getpid()
+        self._cond = threading.Condition()
+        self._queue = deque()
+        self._thread = None
+        self._wakeup = False
+        self._closing = False
+        self._flush_requested = self._flushed = 0
+
+    def handle(self, record):
+        # the worker is the only user of the sender; skip the handler lock
+        rv = self.filter(record)
+        if rv:
+            self.emit(record)
+        return rv
+
+    def emit(self, record):
+        if CHECK_PID and self._pid != os.getpid():
+            self._after_fork()
+        if self._thread is None and not self._closing:
+            self._start()
+        queue = self._queue
+        if len(queue) >= self.queue_size:
+            self.dropped += 1
+            return
+        queue.append(record)
+        if record.levelno >= self.flush_level or len(queue) >= self.batch_size:
+            self._wake()
+
+    def _start(self):
+        self._cond.acquire()
+        try:
+            if self._thread is not None or self._closing:
+                return
+            self._thread = threading.Thread(target=self._run,
+                                            name='pyfluent-handler')
+            self._thread.daemon = True
+            self._thread.start()
+        finally:
+            self._cond.release()
+
+    def _wake(self):
+        self._cond.acquire()
+        try:
+            self._wakeup = True
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def _run(self):
+        cond = self._cond
+        while True:
+            cond.acquire()
+            try:
+                if not (self._wakeup or self._closing):
+                    cond.wait(self.flush_interval)
+                self._wakeup = False
+                requested = self._flush_requested
+                closing = self._closing
+            finally:
+                cond.release()
+            self._send_queued(closing or requested > self._flushed)
+            if closing:
+                self.fluent.close()
+            cond.acquire()
+            try:
+                self._flushed = requested
+                cond.notify_all()
+            finally:
+                cond.release()
+            if closing:
+                return
+
+    def _send_queued(self, flush_windows):
+        queue = self._queue
+        emit = SafeFluentHandler.emit
+        while True:
+            try:
+                record = queue.popleft()
+            except IndexError:
+                break
+            emit(self, record)
+        if flush_windows:
+            SafeFluentHandler.flush(self)
+        elif self.aggregator is not None:
+            # windows close on time even when no record follows
+            self._emit_closed(self.aggregator.expire(time.time()))
+        self.fluent.flush()
+
+    def flush(self, timeout=None):
+        """Wait until the worker has sent the records queued so far.
+
+        Returns False if they were not sent within ``timeout`` seconds
+        (defaults to ``self.fluent.timeout``).
+        """
+        if timeout is None:
+            timeout = self.fluent.timeout
+        deadline = time.time() + timeout
+        self._cond.acquire()
+        try:
+            thread = self._thread
+            if thread is None or not thread.is_alive():
+                return not self._queue
+            self._flush_requested += 1
+            requested = self._flush_requested
+            self._wakeup = True
+            self._cond.notify_all()
+            while self._flushed < requested:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+        finally:
+            self._cond.release()
+
+    def close(self, timeout=None):
+        """Send the queued records and stop the worker."""
+        if timeout is None:
+            timeout = self.fluent.timeout
+        self._cond.acquire()
+        try:
+            thread = self._thread
+            self._closing = True
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+        if thread is not None and thread.is_alive():
+            thread.join(timeout)
+        else:
+            self._send_queued(True)
+            self.fluent.close()
+        logging.Handler.close(self)
+
+
+def _after_fork_in_child():
+    for handler in list(_handlers):
+        handler._after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+class Window(object):
+    __slots__ = ('deadline', 'record', 'count', 'first', 'last')
+
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.record = None
+        self.count = 0
+        self.first = self.last = None
+
+    def add(self, record):
+        if self.record is None:
+            self.record = record
+            self.first = record.created
+        self.count += 1
+        self.last = record.created
+
+
+class RecordAggregator(object):
+    """Collapses records repeated within ``window`` seconds.
+
+    Records are repeated when they have the same logger, level, message
+    template (``record.msg``) and exception location. The first record
+    opens a window and is emitted as usual; its repeats are only counted,
+    and the first of them is emitted with the count when the window
+    closes. Windows are closed by later records and by ``flush``.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self._windows = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, record):
+        """Return whether to emit ``record``, and the closed windows."""
+        key = aggregate_key(record)
+        now = record.created
+        self._lock.acquire()
+        try:
+            closed = self._expire(now)
+            try:
+                window = self._windows.get(key)
+            except TypeError:
+                # unhashable message template
+                return True, closed
+            if window is None:
+                self._windows[key] = Window(now + self.window)
+                return True, closed
+            window.add(record)
+            return False, closed
+        finally:
+            self._lock.release()
+
+    def expire(self, now=None):
+        """Close the windows ending by ``now`` (all of them if None)."""
+        self._lock.acquire()
+        try:
+            return self._expire(now)
+        finally:
+            self._lock.release()
+
+    def _expire(self, now):
+        windows = self._windows
+        closed = []
+        # windows are ordered by their deadline
+        while windows:
+            key = next(iter(windows))
+            window = windows[key]
+            if now is not None and window.deadline > now:
+                break
+            del windows[key]
+            if window.count:
+                closed.append(window)
+        return closed
+
+
+def aggregate_key(record):
+    location = None
+    exc_info = record.exc_info
+    if exc_info and exc_info[2] is not None:
+        tb = exc_info[2]
+        while tb.tb_next is not None:
+            tb = tb.tb_next
+        location = (exc_info[0], tb.tb_frame.f_code.co_filename,
+                    tb.tb_lineno)
+    return record.name, record.levelno, record.msg, location
+
+
+class CachingFormatter(logging.Formatter):
+    """Formatter rendering tracebacks through a TracebackCache."""
+
+    def __init__(self, fmt=None, datefmt=None, tracebacks=None):
         logging.Formatter.__init__(self, fmt, datefmt)
+        if tracebacks is None:
+            tracebacks = TracebackCache()
+        self.tracebacks = tracebacks
+
+    def formatException(self, ei):
+        if ei[0] is None:
+            return logging.Formatter.formatException(self, ei)
+        return self.tracebacks.format(ei)
+
+
+# used by SafeFluentHandler without a formatter
+_default_formatter = CachingFormatter()
+
+
+class FluentFormatter(CachingFormatter):
+    """Formatter which emits the attributes of records as a dict.
+
+    With ``traceback_fingerprints``, records carry the fingerprint of their
+    traceback in ``exc_fingerprint``, and the traceback itself is only
+    emitted the first time; later records with the same traceback only
+    carry the exception message.
+    """
+
+    def __init__(self, fmt=None, datefmt=None, traceback_fingerprints=False):
+        CachingFormatter.__init__(self, fmt, datefmt)
+        self.traceback_fingerprints = traceback_fingerprints
         self.exclude = [
             'args', 'asctime', 'created', 'exc_info', 'levelno', 'msecs',
             'msg', 'relativeCreated', 'thread', 'message'
@@ -83,9 +489,118 @@ class FluentFormatter(logging.Formatter):
             except:
                 pass
             d[key] = value
+        if self.traceback_fingerprints and record.exc_info:
+            self.reference_traceback(record, d)
         return d
 
+    def reference_traceback(self, record, d):
+        exc_type, exc = record.exc_info[:2]
+        if exc_type is None:
+            return
+        fingerprint, new = self.tracebacks.reference(record.exc_info)
+        d['exc_fingerprint'] = fingerprint
+        if new:
+            return
+        text = ''.join(traceback.format_exception_only(exc_type, exc))
+        text = text.rstrip('\n')
+        if record.exc_text:
+            d['message'] = d['message'].replace(record.exc_text, text, 1)
+        if 'exc_text' in d:
+            d['exc_text'] = text
+
     def prepare(self, key, value):
         if key == 'levelname':
             return key, value.lower()
         return key, value
+
+
+def lower(value):
+    return value.lower()
+
+
+DEFAULT_CONVERTERS = {'levelname': lower}
+
+
+class CompiledFluentFormatter(FluentFormatter):
+    """FluentFormatter which caches how to convert each kind of record.
+
+    The attributes to emit and their converters are computed once for each
+    distinct set of record attributes and reused for every record having
+    the same set. ``include`` limits the output to the given attributes,
+    and ``converters`` maps an attribute name to a function converting its
+    value. Unlike FluentFormatter, ``prepare`` is not called.
+
+    Without ``fmt``, ``message`` is the message of the record (followed by
+    the traceback, if any) and no intermediate format string is built.
+    Assign to ``exclude``, ``include`` or ``converters`` to change them;
+    modifying them in place does not discard the cached plans.
+    """
+
+    max_plans = 256
+
+    def __init__(self, fmt=None, datefmt=None, include=None, converters=None,
+                 traceback_fingerprints=False):
+        FluentFormatter.__init__(self, fmt, datefmt, traceback_fingerprints)
+        self._plain = fmt is None
+        self._plans = {}
+        self.include = include
+        self.converters = dict(DEFAULT_CONVERTERS)
+        if converters:
+            self.converters.update(converters)
+
+    def __setattr__(self, name, value):
+        FluentFormatter.__setattr__(self, name, value)
+        if name in ('exclude', 'include', 'converters'):
+            self.__dict__['_plans'] = {}
+
+    def format(self, record):
+        if self._plain:
+            message = self.format_message(record)
+        else:
+            message = logging.Formatter.format(self, record)
+        d = {'message': message, 'hostname': self.hostname}
+        attrs = record.__dict__
+        names = tuple(attrs)
+        plan = self._plans.get(names)
+        if plan is None:
+            plan = self._compile(names)
+        for key, convert in plan:
+            value = attrs[key]
+            if convert is not None:
+                try:
+                    value = convert(value)
+                except Exception:
+                    pass
+            d[key] = value
+        if self.traceback_fingerprints and record.exc_info:
+            self.reference_traceback(record, d)
+        return d
+
+    def format_message(self, record):
+        message = record.getMessage()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            if message[-1:] != '\n':
+                message += '\n'
+            message += record.exc_text
+        stack_info = getattr(record, 'stack_info', None)
+        if stack_info:
+            if message[-1:] != '\n':
+                message += '\n'
+            message += self.formatStack(stack_info)
+        return message
+
+    def _compile(self, names):
+        exclude = set(self.exclude)
+        include = self.include is not None and set(self.include) or None
+        plan = []
+        for key in names:
+            if key in exclude or (include is not None and key not in include):
+                continue
+            plan.append((key, self.converters.get(key)))
+        plans = self._plans
+        if len(plans) >= self.max_plans:
+            plans.clear()
+        plans[names] = plan
+        return plan
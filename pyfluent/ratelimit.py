@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Yoshihisa Tanaka
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+import threading
+import time
+
+
+class TokenBucket(object):
+    """Allows ``rate`` events per second with bursts of ``burst`` events."""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst=None, now=None):
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.tokens = self.burst
+        self.updated = now or time.time()
+
+    def take(self, now):
+        tokens = min(self.burst,
+                     self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if tokens < 1:
+            self.tokens = tokens
+            return False
+        self.tokens = tokens - 1
+        return True
+
+
+class RateLimiter(object):
+    """Limits and samples events per tag before they are serialized.
+
+    ``rates`` maps a tag to events per second allowed for each tag under
+    it, either a number or ``(rate, burst)``; ``rate`` and ``burst`` apply
+    to the other tags. ``sample`` maps a tag to the probability that an
+    event of a tag under it is kept. A tag is under ``app`` if it is
+    ``app`` or starts with ``app.``; the longest matching tag wins.
+
+    If ``summary_tag`` is given, the number of suppressed events of each
+    tag is sent every ``summary_interval`` seconds by the sender (or the
+    handler) using the limiter.
+    """
+
+    max_tags = 1024
+
+    def __init__(self, rate=None, burst=None, rates=None, sample=None,
+                 summary_tag=None, summary_interval=60):
+        self.rate = rate
+        self.burst = burst
+        self.rates = dict(rates or {})
+        self.sample = dict(sample or {})
+        self.summary_tag = summary_tag
+        self.summary_interval = summary_interval
+        self.suppressed = 0
+        self._rules = {}
+        self._limited = {}
+        self._sampled = {}
+        self._next_summary = time.time() + summary_interval
+        self._lock = threading.Lock()
+
+    def allow(self, tag, now=None):
+        """Return whether an event of ``tag`` should be sent."""
+        now = now or time.time()
+        self._lock.acquire()
+        try:
+            rule = self._rules.get(tag)
+            if rule is None:
+                rule = self._resolve(tag, now)
+            bucket, probability = rule
+            if probability is not None and random.random() >= probability:
+                counts = self._sampled
+            elif bucket is not None and not bucket.take(now):
+                counts = self._limited
+            else:
+                return True
+            counts[tag] = counts.get(tag, 0) + 1
+            self.suppressed += 1
+            return False
+        finally:
+            self._lock.release()
+
+    def summary(self, now=None):
+        """Return the record summarizing suppressed events when it is due.
+
+        Returns None if there is nothing to report yet.
+        """
+        now = now or time.time()
+        if not self.summary_tag or now < self._next_summary:
+            return None
+        self._lock.acquire()
+        try:
+            self._next_summary = now + self.summary_interval
+            if not (self._limited or self._sampled):
+                return None
+            record = {'rate_limited': self._limited,
+                      'sampled_out': self._sampled,
+                      'interval': self.summary_interval}
+            self._limited = {}
+            self._sampled = {}
+            return record
+        finally:
+            self._lock.release()
+
+    def _resolve(self, tag, now):
+        rate = match(self.rates, tag, (self.rate, self.burst))
+        if not isinstance(rate, (tuple, list)):
+            rate = (rate, None)
+        bucket = None
+        if rate[0] is not None:
+            bucket = TokenBucket(rate[0], rate[1], now)
+        rule = (bucket, match(self.sample, tag))
+        if len(self._rules) >= self.max_tags:
+            self._rules.clear()
+        self._rules[tag] = rule
+        return rule
+
+
+def match(rules, tag, default=None):
+    """Return the value of the longest tag in ``rules`` covering ``tag``."""
+    while True:
+        if tag in rules:
+            return rules[tag]
+        index = tag.rfind('.')
+        if index < 0:
+            return default
+        tag = tag[:index]
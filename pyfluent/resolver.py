@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Yoshihisa Tanaka
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import socket
+import threading
+import time
+
+
+class Resolver(object):
+    """Cache of resolved addresses filled by background threads.
+
+    ``lookup`` never waits for DNS unless asked to: while a name is being
+    resolved it returns None, and an expired entry is still returned while
+    it is refreshed. Failures are cached for ``negative_ttl`` seconds.
+    """
+
+    def __init__(self, ttl=60, negative_ttl=5):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._cache = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def lookup(self, host, port, timeout=0):
+        """Return the addresses of ``host`` and ``port``.
+
+        Addresses are ``(family, sockaddr)`` tuples in the order given by
+        getaddrinfo; connect to the next one when one fails.
+
+        Returns None if the name is not resolved within ``timeout`` seconds
+        and raises socket.gaierror if the resolution failed.
+        """
+        key = (host, port)
+        self._lock.acquire()
+        try:
+            entry = self._cache.get(key)
+            if entry is None or entry[0] <= time.time():
+                if key not in self._pending:
+                    self._start(key)
+                entry = self._cache.get(key)
+            event = self._pending.get(key)
+        finally:
+            self._lock.release()
+
+        if entry is None and timeout:
+            event.wait(timeout)
+            entry = self._cache.get(key)
+        if entry is None:
+            return None
+        expires, address, error = entry
+        if error is not None:
+            raise error
+        return address
+
+    def _start(self, key):
+        address = numeric_address(*key)
+        if address is not None:
+            # literal addresses never expire
+            self._cache[key] = (float('inf'), [address], None)
+            return
+        event = self._pending[key] = threading.Event()
+        thread = threading.Thread(target=self._resolve, args=(key, event),
+                                  name='pyfluent-resolver')
+        thread.daemon = True
+        thread.start()
+
+    def _resolve(self, key, event):
+        entry = None
+        try:
+            info = socket.getaddrinfo(key[0], key[1], 0, socket.SOCK_STREAM)
+            addresses = []
+            for family, type, proto, name, sockaddr in info:
+                if (family, sockaddr) not in addresses:
+                    addresses.append((family, sockaddr))
+            entry = (time.time() + self.ttl, addresses, None)
+        except socket.gaierror as e:
+            entry = (time.time() + self.negative_ttl, None, e)
+        except Exception as e:
+            # e.g. UnicodeError for an invalid name; senders expect gaierror
+            error = socket.gaierror('%s: %s' % (e.__class__.__name__, e))
+            entry = (time.time() + self.negative_ttl, None, error)
+        finally:
+            self._lock.acquire()
+            try:
+                if entry is not None:
+                    self._cache[key] = entry
+                self._pending.pop(key, None)
+            finally:
+                self._lock.release()
+            event.set()
+
+    def _after_fork(self):
+        # resolver threads do not survive a fork
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._cache.clear()
+        finally:
+            self._lock.release()
+
+
+def numeric_address(host, port):
+    """Return ``(family, sockaddr)`` if ``host`` is an IP address."""
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, host)
+        except (socket.error, ValueError):
+            continue
+        if family == socket.AF_INET6:
+            return family, (host, port, 0, 0)
+        return family, (host, port)
+    return None
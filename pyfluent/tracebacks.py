@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Yoshihisa Tanaka
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import logging
+import threading
+import traceback
+from collections import OrderedDict
+
+try:
+    BaseExceptionGroup
+except NameError:
+    BaseExceptionGroup = None
+
+_CAUSE_MESSAGE = ('\nThe above exception was the direct cause '
+                  'of the following exception:\n\n')
+_CONTEXT_MESSAGE = ('\nDuring handling of the above exception, '
+                    'another exception occurred:\n\n')
+
+
+class TracebackCache(object):
+    """LRU cache of rendered tracebacks.
+
+    Stacks are keyed by the exception type and the code locations of their
+    frames, so an exception raised again at the same place is rendered from
+    the cache; only the exception message is formatted each time. Each
+    stack also has a fingerprint which identifies it across processes.
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._stacks = OrderedDict()
+        self._referenced = OrderedDict()
+        self._lock = threading.Lock()
+
+    def format(self, ei):
+        """Return the same text as ``logging.Formatter.formatException``."""
+        chain = exception_chain(ei)
+        if BaseExceptionGroup is not None and any(
+                isinstance(exc, BaseExceptionGroup) for x, y, exc, z in chain):
+            # the sub-exceptions of groups are not cached
+            return logging.Formatter().formatException(ei)
+        parts = []
+        for separator, exc_type, exc, tb in chain:
+            if separator:
+                parts.append(separator)
+            parts.append(self._stack(exc_type, tb)[0])
+            parts.extend(traceback.format_exception_only(exc_type, exc))
+        text = ''.join(parts)
+        if text[-1:] == '\n':
+            text = text[:-1]
+        return text
+
+    def fingerprint(self, ei):
+        """Return the fingerprint of the stacks of ``ei``."""
+        fingerprints = [self._stack(exc_type, tb)[1]
+                        for separator, exc_type, exc, tb
+                        in exception_chain(ei)]
+        if len(fingerprints) == 1:
+            return fingerprints[0]
+        return digest(' '.join(fingerprints))
+
+    def reference(self, ei):
+        """Return the fingerprint of ``ei`` and whether it is new.
+
+        A fingerprint is new until it was returned by ``reference``, or
+        again after it was evicted from the cache.
+        """
+        fingerprint = self.fingerprint(ei)
+        self._lock.acquire()
+        try:
+            new = self._referenced.pop(fingerprint, None) is None
+            self._referenced[fingerprint] = True
+            if len(self._referenced) > self.maxsize:
+                self._referenced.popitem(last=False)
+            return fingerprint, new
+        finally:
+            self._lock.release()
+
+    def _stack(self, exc_type, tb):
+        key = (exc_type, stack_locations(tb))
+        self._lock.acquire()
+        try:
+            entry = self._stacks.pop(key, None)
+            if entry is not None:
+                self._stacks[key] = entry
+                return entry
+        finally:
+            self._lock.release()
+        text = ''
+        if tb is not None:
+            text = ''.join(['Traceback (most recent call last):\n'] +
+                           traceback.format_tb(tb))
+        entry = (text, digest(exc_type.__name__ + '\n' + text))
+        self._lock.acquire()
+        try:
+            self._stacks[key] = entry
+            if len(self._stacks) > self.maxsize:
+                self._stacks.popitem(last=False)
+        finally:
+            self._lock.release()
+        return entry
+
+    def __len__(self):
+        return len(self._stacks)
+
+
+def exception_chain(ei):
+    """Yield ``(separator, type, exception, traceback)``, oldest first."""
+    exc_type, exc, tb = ei
+    chain = [(None, exc_type, exc, tb)]
+    seen = set([id(exc)])
+    while True:
+        cause = getattr(exc, '__cause__', None)
+        if cause is not None:
+            separator = _CAUSE_MESSAGE
+        else:
+            cause = getattr(exc, '__context__', None)
+            if getattr(exc, '__suppress_context__', False):
+                cause = None
+            separator = _CONTEXT_MESSAGE
+        if cause is None or id(cause) in seen:
+            break
+        seen.add(id(cause))
+        chain[-1] = (separator, ) + chain[-1][1:]
+        exc = cause
+        chain.append((None, type(exc), exc, exc.__traceback__))
+    chain.reverse()
+    return chain
+
+
+def stack_locations(tb):
+    locations = []
+    while tb is not None:
+        locations.append((tb.tb_frame.f_code, tb.tb_lasti))
+        tb = tb.tb_next
+    return tuple(locations)
+
+
+def digest(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
@@ -45,5 +45,8 @@ setup(name=name,
       keywords=['logging', 'fluentd', 'json'],
       install_requires=['msgpack-python>=0.3.0'],
       tests_require=['pytest', 'mock'],
-      packages=find_packages(exclude=['tests'])
+      packages=find_packages(exclude=['tests']),
+      entry_points={
+          'console_scripts': ['pyfluent-cat = pyfluent.cli:main']
+      }
 )
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Yoshihisa Tanaka
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import time
+
+import msgpack
+from mock import patch
+
+from pyfluent import client
+from pyfluent.asyncio import AsyncioFluentSender
+
+
+class FakeServer(object):
+    def __init__(self, delay=0):
+        self.unpacker = msgpack.Unpacker(encoding='utf-8')
+        self.messages = []
+        self.delay = delay
+        self.writers = []
+
+    async def start(self):
+        self.server = await asyncio.start_server(
+            self.handle, '127.0.0.1', 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def handle(self, reader, writer):
+        self.writers.append(writer)
+        await asyncio.sleep(self.delay)
+        while True:
+            data = await reader.read(4096)
+            if not data:
+                break
+            self.unpacker.feed(data)
+            self.messages.extend(self.unpacker)
+        writer.close()
+
+    async def wait(self, count, timeout=5):
+        deadline = time.time() + timeout
+        while len(self.messages) < count and time.time() < deadline:
+            await asyncio.sleep(0.01)
+        return self.messages
+
+    def close(self):
+        self.server.close()
+        for writer in self.writers:
+            writer.close()
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_send():
+    async def main():
+        server = FakeServer()
+        port = await server.start()
+        sender = AsyncioFluentSender(port=port, tag='test')
+        await sender.send('test1', timestamp=1.0)
+        sender.send_nowait('test2', timestamp=2.0)
+        assert await sender.flush(5)
+        messages = await server.wait(2)
+        await sender.aclose()
+        server.close()
+        return messages
+    assert run(main()) == [
+        ['test', 1.0, {'message': 'test1'}],
+        ['test', 2.0, {'message': 'test2'}]
+    ]
+
+
+def test_send_waits_for_frames_in_flight():
+    async def main():
+        server = FakeServer(delay=0.5)
+        port = await server.start()
+        sender = AsyncioFluentSender(port=port, tag='test', timeout=5)
+        for i in range(5):
+            sender.send_nowait('x' * 1024 * 1024)
+        deadline = time.time() + 5
+        while not sender._inflight and time.time() < deadline:
+            await asyncio.sleep(0.01)
+        assert sender._inflight
+        await sender.send('small')
+        sent = sender._sent
+        await sender.aclose()
+        await server.wait(6)
+        server.close()
+        return sent
+    assert run(main()) == 6
+
+
+def test_forward_mode():
+    async def main():
+        server = FakeServer()
+        port = await server.start()
+        sender = AsyncioFluentSender(port=port, tag='test',
+                                     mode=client.FORWARD_MODE)
+        for i in range(3):
+            await sender.send('test%d' % i, timestamp=1.0)
+        await sender.aclose(5)
+        messages = await server.wait(1)
+        server.close()
+        return messages
+    assert run(main()) == [
+        ['test', [[1.0, {'message': 'test%d' % i}] for i in range(3)]]
+    ]
+
+
+def test_send_many():
+    async def main():
+        server = FakeServer()
+        port = await server.start()
+        sender = AsyncioFluentSender(port=port, tag='test', batch_bytes=1024)
+        events = ((None, 1.0, {'i': i}) for i in range(1000))
+        assert await sender.send_many(events) == 1000
+        await sender.aclose(5)
+        messages = await server.wait(1000)
+        server.close()
+        return messages
+    assert run(main()) == [['test', 1.0, {'i': i}] for i in range(1000)]
+
+
+def test_unix_socket(tmpdir):
+    path = str(tmpdir.join('fluentd.sock'))
+
+    async def main():
+        server = FakeServer()
+        server.server = await asyncio.start_unix_server(server.handle, path)
+        sender = AsyncioFluentSender('unix://' + path, None, 'test')
+        await sender.send('test1', timestamp=1.0)
+        messages = await server.wait(1)
+        await sender.aclose()
+        server.close()
+        return messages
+    assert run(main()) == [['test', 1.0, {'message': 'test1'}]]
+
+
+def test_unreachable():
+    async def main():
+        server = FakeServer()
+        port = await server.start()
+        server.close()
+        await server.server.wait_closed()
+        sender = AsyncioFluentSender(port=port, tag='test', timeout=0.2)
+        start = time.time()
+        await sender.send('test')
+        assert not await sender.flush(0.1)
+        await sender.aclose(0.1)
+        assert time.time() - start < 2.0
+        assert sender._retry_time > 0 or len(sender._queue) == 1
+        return list(sender._queue)
+    assert len(run(main())) == 1
+
+
+def test_close_spill(tmpdir):
+    async def main():
+        sender = AsyncioFluentSender(port=1, spill_path=str(tmpdir))
+        with patch.object(sender._spill, 'close') as close:
+            await sender.aclose(0.1)
+            sender.close()
+        return close.call_count
+    assert run(main()) == 2
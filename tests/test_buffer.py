@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Yoshihisa Tanaka
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+from pyfluent.buffer import FileBuffer
+
+
+def frames(count):
+    return [('frame %d' % i).encode('ascii') * (i + 1) for i in range(count)]
+
+
+def drain(buf):
+    result = []
+    frame = buf.peek()
+    while frame is not None:
+        result.append(frame)
+        buf.pop()
+        frame = buf.peek()
+    return result
+
+
+def test_append_and_pop(tmpdir):
+    buf = FileBuffer(str(tmpdir), segment_size=64)
+    expected = frames(10)
+    for frame in expected:
+        assert buf.append(frame)
+    assert len(buf) == 10
+    assert len(os.listdir(str(tmpdir))) > 1
+    assert drain(buf) == expected
+    assert len(buf) == 0
+    assert buf.size == 0
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_interleaved(tmpdir):
+    buf = FileBuffer(str(tmpdir), segment_size=64)
+    expected = frames(10)
+    result = []
+    for frame in expected:
+        buf.append(frame)
+        buf.append(frame)
+        result.append(buf.peek())
+        buf.pop()
+    result.extend(drain(buf))
+    assert result == sorted(expected + expected, key=expected.index)
+
+
+def test_max_size(tmpdir):
+    buf = FileBuffer(str(tmpdir), max_size=100)
+    assert buf.append(b'x' * 50)
+    assert not buf.append(b'x' * 50)
+    assert len(buf) == 1
+
+
+def test_recover(tmpdir):
+    buf = FileBuffer(str(tmpdir), segment_size=64)
+    expected = frames(10)
+    for frame in expected:
+        buf.append(frame)
+    buf.pop()
+    buf.close()
+    buf = FileBuffer(str(tmpdir), segment_size=64)
+    assert drain(buf) == expected
+
+
+def test_recover_torn_write(tmpdir):
+    buf = FileBuffer(str(tmpdir))
+    expected = frames(3)
+    for frame in expected:
+        buf.append(frame)
+    buf.close()
+    filename = os.path.join(str(tmpdir), os.listdir(str(tmpdir))[0])
+    size = os.path.getsize(filename)
+    f = open(filename, 'r+b')
+    f.truncate(size - 1)
+    f.close()
+    buf = FileBuffer(str(tmpdir))
+    assert len(buf) == 2
+    assert drain(buf) == expected[:2]
+
+
+def test_recover_corrupted(tmpdir):
+    buf = FileBuffer(str(tmpdir))
+    for frame in frames(3):
+        buf.append(frame)
+    buf.close()
+    filename = os.path.join(str(tmpdir), os.listdir(str(tmpdir))[0])
+    f = open(filename, 'r+b')
+    f.seek(-1, 2)
+    f.write(b'?')
+    f.close()
+    buf = FileBuffer(str(tmpdir))
+    assert len(buf) == 2
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Yoshihisa Tanaka
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import json
+import socket
+import threading
+
+import msgpack
+import pytest
+from mock import patch
+
+from pyfluent import cli
+from pyfluent.client import PackedRecord
+
+
+def parse(argv):
+    return cli.make_parser().parse_args(argv)
+
+
+def named(data, name='input'):
+    f = io.BytesIO(data)
+    f.name = name
+    return f
+
+
+def test_read_json():
+    data = b'{"a": 1}\n\n{"tag": "app", "time": 10, "b": 2}\nnot json\n'
+    errors = []
+    events = list(cli.read_json(named(data), parse([]), errors))
+    assert events == [(None, None, {'a': 1}),
+                      (None, None, {'tag': 'app', 'time': 10, 'b': 2})]
+    assert len(errors) == 1 and errors[0].startswith('input:4:')
+    events = list(cli.read_json(named(data), parse(['--tag-key', 'tag',
+                                                    '--time-key', 'time']),
+                                []))
+    assert events[1] == ('app', 10, {'b': 2})
+
+
+def test_parse_time():
+    assert cli.parse_time(None) is None
+    assert cli.parse_time(10) == 10
+    assert cli.parse_time(1.5) == 1.5
+    assert cli.parse_time('1.5') == 1.5
+    assert cli.parse_time('2024-01-01T00:00:00Z') == 1704067200
+    assert cli.parse_time('2024-01-01T09:00:00.5+09:00') == 1704067200.5
+    assert cli.parse_time('2024-01-01 00:00:00') == 1704067200
+    ext = msgpack.ExtType(0, b'\0' * 8)
+    assert cli.parse_time(ext) is ext
+    for value in ('yesterday', True, [1], {}):
+        with pytest.raises(ValueError):
+            cli.parse_time(value)
+
+
+def test_read_json_time():
+    data = (b'{"time": "2024-01-01T00:00:00Z", "a": 1}\n'
+            b'{"time": "soon", "a": 2}\n')
+    errors = []
+    events = list(cli.read_json(named(data), parse(['--time-key', 'time']),
+                                errors))
+    assert events == [(None, 1704067200, {'a': 1})]
+    assert errors == ["input:2: invalid time: 'soon'"]
+
+
+def test_read_msgpack_time():
+    data = msgpack.packb(['app', 'soon', {'a': 1}], use_bin_type=True)
+    data += msgpack.packb(['app', '10', {'a': 2}], use_bin_type=True)
+    errors = []
+    events = list(cli.read_msgpack(named(data), parse([]), errors))
+    assert events == [('app', 10.0, {'a': 2})]
+    assert errors == ["input: object 1: invalid time: 'soon'"]
+
+
+def test_read_msgpack():
+    records = [{'i': i} for i in range(100)]
+    data = b''.join(msgpack.packb(r) for r in records)
+    data += msgpack.packb(['app', 10, {'a': 1}], use_bin_type=True)
+    errors = []
+    with patch('pyfluent.cli.READ_SIZE', 7):
+        events = list(cli.read_msgpack(named(data), parse([]), errors))
+    assert not errors
+    assert len(events) == 101
+    # maps are passed through as they are read
+    assert all(type(x[2]) is PackedRecord for x in events[:100])
+    assert [msgpack.unpackb(x[2]) for x in events[:100]] == [
+        {b'i': i} for i in range(100)]
+    assert events[100] == ('app', 10, {'a': 1})
+
+
+def test_read_msgpack_keys():
+    data = msgpack.packb({'tag': 'app', 'a': 1}) + b'\x81'
+    errors = []
+    events = list(cli.read_msgpack(named(data), parse(['--tag-key', 'tag']),
+                                   errors))
+    assert events == [('app', None, {'a': 1})]
+    assert errors == ['input: truncated msgpack object']
+
+
+def test_read_msgpack_invalid_utf8():
+    data = msgpack.packb(['app', 10, {'a': b'\xff'}])
+    data += msgpack.packb(['app', 10, {'a': 1}], use_bin_type=True)
+    errors = []
+    events = list(cli.read_msgpack(named(data), parse([]), errors))
+    assert events == [('app', 10, {'a': 1})]
+    assert len(errors) == 1 and errors[0].startswith('input: object 1:')
+
+
+def test_main_error():
+    with patch('pyfluent.client.FluentSender') as sender:
+        sender.return_value.send_many.side_effect = IOError('failed')
+        with pytest.raises(IOError):
+            cli.main(['-'])
+    sender.return_value.close.assert_called_once_with()
+
+
+def test_main(tmpdir):
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    received = []
+
+    def serve():
+        conn = listener.accept()[0]
+        unpacker = msgpack.Unpacker(encoding='utf-8')
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                break
+            unpacker.feed(data)
+            received.extend(unpacker)
+        conn.close()
+
+    thread = threading.Thread(target=serve)
+    thread.start()
+    path = tmpdir.join('input.jsonl')
+    path.write('\n'.join(json.dumps({'i': i}) for i in range(10)))
+    port = str(listener.getsockname()[1])
+    assert cli.main(['--port', port, '--tag', 'test', '--mode', 'forward',
+                     str(path)]) == 0
+    thread.join(5)
+    listener.close()
+    assert [tag for tag, entries in received] == ['test']
+    assert [record for t, record in received[0][1]] == [
+        {'i': i} for i in range(10)]
@@ -15,14 +15,21 @@
 
 from __future__ import with_statement
 
+import os
+import datetime
 import time
+import errno
+import select
 import socket
+import threading
+import zlib
 
 import msgpack
 import pytest
 from mock import MagicMock, patch, call
 
 from pyfluent import client
+from pyfluent.ratelimit import RateLimiter
 
 import sys
 if sys.version_info[:2] <= (2, 5):
@@ -71,25 +78,74 @@ class TestFluentSender(object):
         assert list(sender._queue) == expect
 
     def test_make_socket(self, sender):
-        with patch('socket.socket'):
+        sender.host = '127.0.0.1'
+        with patch('socket.socket') as mock:
+            mock.return_value.connect_ex.return_value = errno.EINPROGRESS
             sock = sender._make_socket()
             assert sock.mock_calls == [
-                call.settimeout(sender.timeout),
-                call.connect((sender.host, sender.port))
+                call.setblocking(False),
+                call.connect_ex(('127.0.0.1', sender.port))
             ]
 
+    def test_make_socket_refused(self, sender):
+        sender.host = '127.0.0.1'
+        with patch('socket.socket') as mock:
+            mock.return_value.connect_ex.return_value = errno.ECONNREFUSED
+            with pytest.raises(socket.error):
+                sender._make_socket()
+            assert mock.return_value.close.call_count == 1
+
+    def test_make_socket_resolving(self):
+        sender = client.FluentSender('fluent.invalid', tag='test')
+        sender.resolver = MagicMock()
+        sender.resolver.lookup.return_value = None
+        with patch('socket.socket') as mock:
+            assert sender._make_socket() is None
+            assert mock.call_count == 0
+
+    def test_next_address(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        port = listener.getsockname()[1]
+        # nothing listens on the first address
+        unused = socket.socket()
+        unused.bind(('127.0.0.1', 0))
+        sender = client.FluentSender('fluent.example.com', port, 'test')
+        sender.resolver = MagicMock()
+        sender.resolver.lookup.return_value = [
+            (socket.AF_INET, unused.getsockname()),
+            (socket.AF_INET, ('127.0.0.1', port)),
+        ]
+        sender.send('test')
+        sender.flush()
+        assert sender.connect_failures == 1
+        assert sender._sock is not None
+        assert sender._address == 1
+        assert sender._retry_time == 0
+        conn = listener.accept()[0]
+        conn.settimeout(5)
+        assert msgpack.unpackb(conn.recv(65536), encoding='utf-8')[2] == {
+            'message': 'test'}
+        sender.close()
+        for sock in (conn, listener, unused):
+            sock.close()
+
     def test_create_socket(self, sender):
         sender._retry_time = time.time() + 1000
         sender._create_socket()
         assert sender._sock == None
         sender._retry_time = time.time()
-        with patch('socket.socket'):
-            sender._create_socket()
-            assert sender._sock is not None
-            assert sender._retry_time == 0
-            assert next(sender._wait_time) == 1.0
+        server, sock = socket.socketpair()
+        sender._make_socket = lambda: sock
+        sender._create_socket()
+        assert sender._sock is sock
+        assert sender._retry_time == 0
+        assert next(sender._wait_time) == 1.0
+        server.close()
 
     def test_create_socket_error(self, sender):
+        sender.host = '127.0.0.1'
         with patch('socket.socket') as mock:
             mock.side_effect = socket.error
             now = time.time()
@@ -98,14 +154,53 @@ class TestFluentSender(object):
             assert now < sender._retry_time < now + 2.0
             assert next(sender._wait_time) == 2.0
 
+    def test_connect_in_progress(self, sender):
+        sock = MagicMock(spec=socket.socket)
+        sender._make_socket = lambda: sock
+        with patch('select.select') as select:
+            select.return_value = ([], [], [])
+            assert sender.socket is None
+            assert sender._connecting is sock
+            assert sender.connects == 1
+            select.return_value = ([], [sock], [])
+            sock.getsockopt.return_value = 0
+            assert sender.socket is sock
+            assert sender._connecting is None
+            assert sender.connects == 1
+
+    def test_connect_timeout(self, sender):
+        sock = MagicMock(spec=socket.socket)
+        sender._make_socket = lambda: sock
+        with patch('select.select') as select:
+            select.return_value = ([], [], [])
+            assert sender.socket is None
+            sender._connect_deadline = time.time()
+            assert sender.socket is None
+        assert sender._connecting is None
+        assert sock.close.call_count == 1
+        assert sender.connect_failures == 1
+        assert sender._retry_time > time.time()
+
+    def test_connect_refused(self, sender):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        sender.port = listener.getsockname()[1]
+        listener.close()
+        sender._connect(block=True)
+        assert sender._sock is None
+        assert sender._connecting is None
+        assert sender.connect_failures == 1
+
     def test_get_socket(self, sender):
-        with patch('socket.socket'):
-            assert sender._sock is None
-            sock1 = sender.socket
-            assert sock1 is not None
-            assert sender._sock is sock1
-            sock2 = sender.socket
-            assert sock1 is sock2
+        server, sock = socket.socketpair()
+        sender._make_socket = lambda: sock
+        assert sender._sock is None
+        sock1 = sender.socket
+        assert sock1 is not None
+        assert sender._sock is sock1
+        sock2 = sender.socket
+        assert sock1 is sock2
+        server.close()
 
     def test_close(self, sender):
         sender.close()
@@ -136,15 +231,48 @@ class TestFluentSender(object):
         r = sender.serialize(data, tag, timestamp)
         assert msgpack.unpackb(r, encoding='utf-8') == [tag, timestamp, data]
 
+    def test_serialize_same_as_packer(self, sender):
+        data = {'string': 'test', 'number': 10}
+        for timestamp in (time.time(), 1000):
+            expected = msgpack.packb(['pyfluent.test', timestamp, data],
+                                     encoding='utf-8')
+            assert sender.serialize(data, 'pyfluent.test',
+                                    timestamp) == expected
+            expected = msgpack.packb([timestamp, data], encoding='utf-8')
+            assert sender.serialize_entry(data, timestamp) == expected
+
+    def test_serialize_nanosecond_precision(self):
+        sender = client.FluentSender(tag='test', nanosecond_precision=True)
+        data = {'message': 'test'}
+        r = msgpack.unpackb(sender.serialize(data), encoding='utf-8')
+        assert isinstance(r[1], msgpack.ExtType) and r[1].code == 0
+        r = msgpack.unpackb(sender.serialize_entry(data, 1000.5),
+                            encoding='utf-8')
+        assert r == [msgpack.ExtType(0, b'\x00\x00\x03\xe8\x1d\xcd\x65\x00'),
+                     data]
+
+    def test_serialize_unknown_types(self, sender):
+        data = {'created': datetime.date(2019, 1, 10), 'obj': object}
+        r = msgpack.unpackb(sender.serialize(data), encoding='utf-8')
+        assert r[2] == {'created': '2019-01-10', 'obj': repr(object)}
+
+    def test_serialize_packed_record(self, sender):
+        packed = client.PackedRecord(msgpack.packb({'a': 1}))
+        assert sender.serialize_entry(packed, 1.0) == msgpack.packb(
+            [1.0, {'a': 1}])
+
     def test_send_normal(self, sender, msgs):
-        with patch('socket.socket'):
+        sock = MagicMock(spec=socket.socket)
+        sock.sendmsg.side_effect = written(sock)
+        sock.getsockopt.return_value = 0
+        sender._make_socket = lambda: sock
+        with patch('select.select') as select:
+            select.side_effect = lambda r, w, x, t: ([], w, [])
             timestamp = time.time()
             f = lambda d: msgpack.packb([sender.tag, timestamp, d])
             sender.send(msgs[0], timestamp=timestamp)
             sender.send(msgs[1], timestamp=timestamp)
-            assert sender._sock.sendall.call_args_list == [
-                call(f(msgs[0])), call(f(msgs[1]))
-            ]
+            assert sock.written == [f(msgs[0]), f(msgs[1])]
             assert len(sender._queue) == 0
 
     def test_send_fail(self, sender, msgs):
@@ -159,26 +287,939 @@ class TestFluentSender(object):
     def test_send_retransmit(self, sender, msgs):
         mock = MagicMock(spec=socket.socket)
         sender._sock = mock
-        sendall = sender._sock.sendall
-        sendall.side_effect = socket.error
+        sendmsg = mock.sendmsg
+        sendmsg.side_effect = socket.error(errno.EPIPE, 'Broken pipe')
         timestamp = time.time()
         f = lambda d: msgpack.packb([sender.tag, timestamp, d])
-        # try 1 then fail
-        sender.send(msgs[0], timestamp=timestamp)
-        assert sendall.call_args_list == [call(f(msgs[0]))]
-        assert list(sender._queue) == [f(msgs[0])]
-        assert sender._sock == None
-        # try 2 then fail
-        sender._sock = mock
-        sendall.reset_mock()
-        sender.send(msgs[1], timestamp=timestamp)
-        assert sendall.call_args_list == [call(f(msgs[0]))]
-        assert list(sender._queue) == [f(msgs[0]), f(msgs[1])]
-        assert sender._sock == None
-        # try 3 then success
-        sender._sock = mock
-        sendall.reset_mock()
-        sendall.side_effect = None
-        sender.send(msgs[2], timestamp=timestamp)
-        assert sendall.call_args_list == [call(f(msgs[x])) for x in range(3)]
+        with patch('select.select') as select:
+            select.side_effect = lambda r, w, x, t: ([], w, [])
+            # try 1 then fail
+            sender.send(msgs[0], timestamp=timestamp)
+            assert sendmsg.call_count == 1
+            assert list(sender._queue) == [f(msgs[0])]
+            assert sender._sock == None
+            # try 2 then fail
+            sender._sock = mock
+            sender.send(msgs[1], timestamp=timestamp)
+            assert list(sender._queue) == [f(msgs[0]), f(msgs[1])]
+            assert sender._sock == None
+            # try 3 then success
+            sender._sock = mock
+            sendmsg.side_effect = written(mock)
+            sender.send(msgs[2], timestamp=timestamp)
+        assert mock.written == [b''.join(f(msgs[x]) for x in range(3))]
+        assert len(sender._queue) == 0
+
+    def test_partial_write(self, sender, msgs):
+        sock = MagicMock(spec=socket.socket)
+        sock.sendmsg.side_effect = written(sock, limit=10)
+        frames = [sender.serialize(x, timestamp=1.0) for x in msgs]
+        for frame in frames:
+            sender._enqueue(frame)
+        sender._write(sock)
+        assert sender._partial is frames[0]
+        assert sender._partial_offset == 10
+        assert len(sender._queue) == 2
+        sock.sendmsg.side_effect = written(sock)
+        sender._write(sock)
+        assert sock.written == [b''.join(frames)[10:]]
+        assert sender._partial is None
+        assert sender.frames_sent == 3
+        assert sender.bytes_sent == sum(len(x) for x in frames)
+
+    def test_partial_write_disconnect(self, sender, msgs):
+        sock = MagicMock(spec=socket.socket)
+        sock.sendmsg.side_effect = written(sock, limit=10)
+        frame = sender.serialize(msgs[0], timestamp=1.0)
+        sender._enqueue(frame)
+        sender._write(sock)
+        sender._enqueue(frame)
+        sender.overflow = client.DROP_OLDEST
+        sender.capacity = 1
+        sender._make_room(0)
+        assert sender._partial is frame
+        sender._disconnect()
+        assert sender._partial is None
+        assert list(sender._queue) == [frame]
+
+    def test_partial_write_disconnect_capacity(self, msgs):
+        sender = client.FluentSender(tag='test', capacity=2)
+        sock = MagicMock(spec=socket.socket)
+        sock.sendmsg.side_effect = written(sock, limit=10)
+        frames = [sender.serialize(x, timestamp=1.0) for x in msgs]
+        sender._enqueue(frames[0])
+        sender._write(sock)
+        sender._enqueue(frames[1])
+        sender._enqueue(frames[2])
+        sender._disconnect()
+        assert list(sender._queue) == frames[:2]
+        assert sender._queue_bytes == len(frames[0]) + len(frames[1])
+        assert sender.dropped == 1
+        assert sender.dropped_bytes == len(frames[2])
+
+
+def written(sock, limit=None):
+    """Return a sendmsg side effect which records the written frames."""
+    sock.written = []
+
+    def sendmsg(buffers):
+        data = b''.join(bytes(x) for x in buffers)[:limit]
+        sock.written.append(data)
+        return len(data)
+    return sendmsg
+
+
+class TestForwardMode(object):
+    def pytest_funcarg__sender(self, request):
+        return client.FluentSender(tag='test', mode=client.FORWARD_MODE)
+
+    def test_batching(self, sender):
+        sender._flush_queue = MagicMock()
+        sender.send({'message': 'test1'}, timestamp=1.0)
+        sender.send({'message': 'test2'}, 'other', 2.0)
+        sender.send({'message': 'test3'}, timestamp=3.0)
+        assert sender._flush_queue.call_count == 0
         assert len(sender._queue) == 0
+        assert sender._batch_count == 3
+        sender.flush()
+        frames = [msgpack.unpackb(x, encoding='utf-8') for x in sender._queue]
+        assert sorted(frames) == [
+            ['other', [[2.0, {'message': 'test2'}]]],
+            ['test', [[1.0, {'message': 'test1'}],
+                      [3.0, {'message': 'test3'}]]]
+        ]
+        assert sender._batch_count == sender._batch_bytes == 0
+        assert sender._flush_queue.call_count == 1
+
+    def test_batch_size(self, sender):
+        sender._flush_queue = MagicMock()
+        sender.batch_size = 2
+        sender.send('test1')
+        assert sender._flush_queue.call_count == 0
+        sender.send('test2')
+        assert sender._flush_queue.call_count == 1
+        assert len(sender._queue) == 1
+        assert sender._batch_count == 0
+
+    def test_batch_bytes(self, sender):
+        sender._flush_queue = MagicMock()
+        sender.batch_bytes = 10
+        sender.send('a long enough message')
+        assert sender._flush_queue.call_count == 1
+        assert len(sender._queue) == 1
+
+    def test_batch_interval(self, sender):
+        sender._flush_queue = MagicMock()
+        sender.send('test1')
+        sender._batch_started -= sender.batch_interval
+        sender.send('test2')
+        assert sender._flush_queue.call_count == 1
+        frame = msgpack.unpackb(sender._queue[0], encoding='utf-8')
+        assert len(frame[1]) == 2
+
+    def test_close_flushes(self, sender):
+        sender._flush_queue = MagicMock()
+        sender.send('test1')
+        sender.close()
+        assert sender._flush_queue.call_count == 1
+        assert len(sender._queue) == 1
+
+
+def test_tag_cache():
+    tags = client.TagCache(maxsize=2)
+    assert tags.pack('a') == msgpack.packb('a', encoding='utf-8')
+    tags.pack('b')
+    tags.pack('a')
+    tags.pack('c')
+    # 'b' was the least recently used
+    assert list(tags._packed) == ['a', 'c']
+    assert len(tags) == 2
+
+
+def test_pack_bin_header():
+    for size in (0, 10, 0xff, 0x100, 0xffff, 0x10000):
+        payload = b'x' * size
+        packed = client.pack_bin_header(size) + payload
+        assert msgpack.unpackb(packed) == payload
+
+
+def test_gzip_compress():
+    data = b'pyfluent' * 100
+    compressed = client.gzip_compress(data)
+    assert len(compressed) < len(data)
+    assert zlib.decompress(compressed, 16 + zlib.MAX_WBITS) == data
+
+
+class TestPackedForwardMode(object):
+    def unpack_entries(self, payload):
+        unpacker = msgpack.Unpacker(encoding='utf-8')
+        unpacker.feed(payload)
+        return list(unpacker)
+
+    def test_packed_forward(self):
+        sender = client.FluentSender(tag='test',
+                                     mode=client.PACKED_FORWARD_MODE)
+        sender._flush_queue = MagicMock()
+        sender.send('test1', timestamp=1.0)
+        sender.send('test2', timestamp=2.0)
+        sender.flush()
+        tag, payload, option = msgpack.unpackb(sender._queue[0])
+        assert tag == b'test'
+        assert option == {b'size': 2}
+        assert self.unpack_entries(payload) == [
+            [1.0, {'message': 'test1'}], [2.0, {'message': 'test2'}]
+        ]
+
+    def test_compressed_packed_forward(self):
+        sender = client.FluentSender(
+            tag='test', mode=client.COMPRESSED_PACKED_FORWARD_MODE,
+            compress_min_size=0)
+        sender._flush_queue = MagicMock()
+        sender.send('test1', timestamp=1.0)
+        sender.send('test2', timestamp=2.0)
+        sender.flush()
+        tag, payload, option = msgpack.unpackb(sender._queue[0])
+        assert option == {b'size': 2, b'compressed': b'gzip'}
+        payload = zlib.decompress(payload, 16 + zlib.MAX_WBITS)
+        assert self.unpack_entries(payload) == [
+            [1.0, {'message': 'test1'}], [2.0, {'message': 'test2'}]
+        ]
+
+    def test_compress_min_size(self):
+        sender = client.FluentSender(
+            tag='test', mode=client.COMPRESSED_PACKED_FORWARD_MODE)
+        sender._flush_queue = MagicMock()
+        sender.send('test1', timestamp=1.0)
+        sender.flush()
+        tag, payload, option = msgpack.unpackb(sender._queue[0])
+        assert option == {b'size': 1}
+        assert self.unpack_entries(payload) == [[1.0, {'message': 'test1'}]]
+
+
+class TestAsyncFluentSender(object):
+    def pytest_funcarg__pair(self, request):
+        server, sock = socket.socketpair()
+        sock.setblocking(False)
+        request.addfinalizer(server.close)
+        return server, sock
+
+    def read_messages(self, server, count):
+        unpacker = msgpack.Unpacker(encoding='utf-8')
+        messages = []
+        server.settimeout(5)
+        while len(messages) < count:
+            unpacker.feed(server.recv(4096))
+            messages.extend(unpacker)
+        return messages
+
+    def test_send_does_not_connect(self):
+        sender = client.AsyncFluentSender(tag='test')
+        sender._flush_queue = MagicMock()
+        with patch('socket.socket') as mock:
+            sender.send('test')
+            assert mock.call_count == 0
+        sender.close(0.1)
+
+    def test_send(self, pair):
+        server, sock = pair
+        sender = client.AsyncFluentSender(tag='test')
+        sender._make_socket = lambda: sock
+        sender.send('test1', timestamp=1.0)
+        sender.send('test2', timestamp=2.0)
+        assert sender.flush(5)
+        assert self.read_messages(server, 2) == [
+            ['test', 1.0, {'message': 'test1'}],
+            ['test', 2.0, {'message': 'test2'}]
+        ]
+        sender.close()
+        assert not sender._thread.is_alive()
+        assert sender._sock is None
+
+    def test_forward_mode(self, pair):
+        server, sock = pair
+        sender = client.AsyncFluentSender(tag='test',
+                                          mode=client.FORWARD_MODE)
+        sender._make_socket = lambda: sock
+        sender.send('test1', timestamp=1.0)
+        sender.send('test2', timestamp=2.0)
+        sender.close(5)
+        assert self.read_messages(server, 1) == [
+            ['test', [[1.0, {'message': 'test1'}],
+                      [2.0, {'message': 'test2'}]]]
+        ]
+
+    def test_threads(self, pair):
+        server, sock = pair
+        sender = client.AsyncFluentSender(tag='test',
+                                          mode=client.FORWARD_MODE)
+        sender._make_socket = lambda: sock
+
+        def send(n):
+            for i in range(100):
+                sender.send({'thread': n, 'i': i}, timestamp=1.0)
+        threads = [threading.Thread(target=send, args=(n, ))
+                   for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert sender.flush(5)
+        assert sender.events == 400
+        assert len(sender._buffers) <= 1
+        sender.close()
+        received = []
+        unpacker = msgpack.Unpacker(encoding='utf-8')
+        server.settimeout(5)
+        while len(received) < 400:
+            unpacker.feed(server.recv(65536))
+            for tag, entries in unpacker:
+                received.extend(record for timestamp, record in entries)
+        for n in range(4):
+            records = [x['i'] for x in received if x['thread'] == n]
+            assert records == list(range(100))
+
+    def test_packer_per_thread(self):
+        sender = client.AsyncFluentSender(tag='test')
+        packers = []
+        thread = threading.Thread(target=lambda: packers.append(sender.packer))
+        thread.start()
+        thread.join()
+        assert packers[0] is not sender.packer
+        assert sender.packer is sender.packer
+
+    def test_close_unreachable(self):
+        sender = client.AsyncFluentSender(tag='test')
+        sender._make_socket = MagicMock(side_effect=socket.error)
+        sender.send('test')
+        assert not sender.flush(0.1)
+        start = time.time()
+        sender.close(0.2)
+        assert time.time() - start < 1.0
+        assert not sender._thread.is_alive()
+        assert len(sender._queue) == 1
+        assert sender._make_socket.call_count == 1
+
+
+class TestSpill(object):
+    def test_spill_ordering(self, tmpdir):
+        sender = client.FluentSender(tag='test', capacity=2,
+                                     spill_path=str(tmpdir))
+        sender._flush_queue = MagicMock()
+        for i in range(5):
+            sender.send(i, timestamp=1.0)
+        assert len(sender._queue) == 2
+        assert len(sender._spill) == 3
+        sender._queue.popleft()
+        sender.send(5, timestamp=1.0)
+        assert len(sender._queue) == 1
+        assert len(sender._spill) == 4
+
+        sock = MagicMock(spec=socket.socket)
+        sock.sendmsg.side_effect = written(sock)
+        del sender._flush_queue
+        sender._queue.popleft()
+        sender._write(sock)
+        sent = [msgpack.unpackb(x, encoding='utf-8')[2]['message']
+                for x in sock.written]
+        assert sent == [2, 3, 4, 5]
+        assert len(sender._spill) == 0
+
+    def test_default_capacity(self, tmpdir):
+        sender = client.FluentSender(spill_path=str(tmpdir))
+        assert sender.capacity == client.DEFAULT_SPILL_CAPACITY
+        assert sender._queue.maxlen == client.DEFAULT_SPILL_CAPACITY
+
+    def test_close_async(self, tmpdir):
+        sender = client.AsyncFluentSender(port=1, spill_path=str(tmpdir))
+        with patch.object(sender._spill, 'close') as close:
+            sender.close(0.1)
+        close.assert_called_once_with()
+
+
+class TestOverflow(object):
+    def make_sender(self, **kwargs):
+        sender = client.FluentSender(tag='test', **kwargs)
+        sender._flush_queue = MagicMock()
+        return sender
+
+    def test_queue_bytes(self):
+        sender = self.make_sender()
+        sender.send('test1')
+        sender.send('test2')
+        assert sender._queue_bytes == sum(len(x) for x in sender._queue)
+        sender._dequeue(sender._queue[0])
+        assert sender._queue_bytes == len(sender._queue[0])
+        sender._dequeue(b'not the head')
+        assert len(sender._queue) == 1
+
+    def test_drop_oldest(self):
+        sender = self.make_sender(max_queue_bytes=100)
+        for i in range(10):
+            sender.send('x' * 20, timestamp=float(i))
+        assert sender._queue_bytes <= 100
+        assert len(sender._queue) + sender.dropped == 10
+        assert sender.dropped_bytes == sender.dropped * len(sender._queue[0])
+        last = msgpack.unpackb(sender._queue[-1], encoding='utf-8')
+        assert last[1] == 9.0
+
+    def test_drop_oldest_capacity(self):
+        sender = self.make_sender(capacity=2)
+        for i in range(3):
+            sender.send(i)
+        assert sender.dropped == 1
+        assert [msgpack.unpackb(x)[2][b'message'] for x in sender._queue] \
+            == [1, 2]
+
+    def test_zero_capacity(self):
+        for overflow in (client.DROP_OLDEST, client.DROP_NEWEST,
+                         client.BLOCK):
+            sender = self.make_sender(capacity=0, overflow=overflow,
+                                      block_timeout=10)
+            start = time.time()
+            sender.send(0)
+            assert time.time() - start < 1.0
+            assert sender.dropped == 1
+            assert len(sender._queue) == 0
+
+    def test_drop_newest(self):
+        sender = self.make_sender(capacity=2, overflow=client.DROP_NEWEST)
+        for i in range(3):
+            sender.send(i)
+        assert sender.dropped == 1
+        assert [msgpack.unpackb(x)[2][b'message'] for x in sender._queue] \
+            == [0, 1]
+
+    def test_block(self):
+        sender = self.make_sender(capacity=1, overflow=client.BLOCK,
+                                  block_timeout=0.1)
+        sender._make_socket = MagicMock(side_effect=socket.error)
+        sender.send(0)
+        start = time.time()
+        sender.send(1)
+        assert 0.1 <= time.time() - start < 1.0
+        assert sender.dropped == 1
+        assert len(sender._queue) == 1
+
+    def test_block_flushes(self):
+        sender = self.make_sender(capacity=1, overflow=client.BLOCK)
+        sender._sock = MagicMock()
+        sender.send(0)
+        sender._flush_queue.side_effect = \
+            lambda *args, **kwargs: sender._queue.clear()
+        sender.send(1)
+        assert sender.dropped == 0
+        assert sender._flush_queue.call_count == 3
+
+    def test_block_waits_for_socket(self):
+        server, sock = socket.socketpair()
+        sock.setblocking(False)
+        # fluentd does not read
+        try:
+            while True:
+                sock.send(b'\0' * 65536)
+        except socket.error:
+            pass
+        sender = client.FluentSender(tag='test', capacity=1,
+                                     overflow=client.BLOCK, block_timeout=0.3)
+        sender._sock = sock
+        sender.send('x')
+        assert len(sender._queue) == 1
+        with patch('select.select', wraps=select.select) as poll:
+            start = time.time()
+            sender.send('x')
+            assert 0.3 <= time.time() - start < 1.0
+        # the socket was waited for, not polled
+        assert poll.call_count < 20
+        assert sender.dropped == 1
+        server.close()
+        sock.close()
+
+    def test_is_full(self):
+        sender = self.make_sender(max_queue_bytes=100)
+        assert not sender.is_full()
+        sender.send('x' * 20)
+        assert not sender.is_full()
+        assert sender.is_full(60)
+
+
+class TestAsyncOverflow(object):
+    def test_block_until_flushed(self):
+        sender = client.AsyncFluentSender(tag='test', capacity=1,
+                                          overflow=client.BLOCK)
+        sent = []
+
+        def flush_queue():
+            time.sleep(0.05)
+            frame = sender._peek()
+            sent.append(frame)
+            sender._dequeue(frame)
+        sender._sock = MagicMock()
+        sender._flush_queue = flush_queue
+        for i in range(3):
+            sender.send(i)
+        assert sender.flush(5)
+        sender.close(1)
+        assert sender.dropped == 0
+        assert len(sent) == 3
+
+
+class TestStats(object):
+    def test_counters(self):
+        sender = client.FluentSender(tag='test', capacity=1,
+                                     overflow=client.DROP_NEWEST)
+        sender._make_socket = MagicMock(side_effect=socket.error)
+        sender.send('test1')
+        sender.send('test2')
+        stats = sender.stats()
+        assert stats['events'] == 2
+        assert stats['frames_sent'] == 0
+        assert stats['queue_length'] == 1
+        assert stats['queue_bytes'] == len(sender._queue[0])
+        assert stats['dropped'] == 1
+        assert stats['connects'] == 1
+        assert stats['connect_failures'] == 1
+        assert not stats['connected']
+        assert stats['send_latency']['count'] == 2
+
+    def test_frames_sent(self):
+        sender = client.FluentSender(tag='test')
+        sender._flush_queue = MagicMock()
+        sender.send('test')
+        frame = sender._peek()
+        sock = MagicMock(spec=socket.socket)
+        sock.sendmsg.side_effect = written(sock)
+        sender._write(sock)
+        assert sender.stats()['frames_sent'] == 1
+        assert sender.stats()['bytes_sent'] == len(frame)
+
+    def test_report(self):
+        sender = client.FluentSender(tag='test', stats_tag='pyfluent.stats',
+                                     stats_interval=10)
+        sender._flush_queue = MagicMock()
+        sender.send('test1')
+        assert len(sender._queue) == 1
+        sender._next_report = time.time()
+        sender.send('test2')
+        frames = [msgpack.unpackb(x, encoding='utf-8') for x in sender._queue]
+        assert [x[0] for x in frames] == ['test', 'pyfluent.stats', 'test']
+        assert frames[1][2]['events'] == 1
+        assert sender._next_report > time.time() + 9
+
+
+class TestRateLimit(object):
+    def test_send(self):
+        limiter = RateLimiter(rates={'app': (1, 1)})
+        sender = client.FluentSender(tag='app', rate_limiter=limiter)
+        sender._make_socket = MagicMock(side_effect=socket.error)
+        sender.send('first')
+        sender.send('second')
+        sender.send('other', 'other')
+        assert len(sender._queue) == 2
+        assert sender.stats()['suppressed'] == 1
+
+    def test_summary(self):
+        limiter = RateLimiter(rate=0.001, summary_tag='suppressed',
+                              summary_interval=0)
+        sender = client.FluentSender(tag='app', rate_limiter=limiter)
+        sender._make_socket = MagicMock(side_effect=socket.error)
+        sender.send('first')
+        sender.send('second')
+        sender.send('third')
+        assert len(sender._queue) == 2
+        tag, timestamp, record = msgpack.unpackb(sender._queue[1],
+                                                 encoding='utf-8')
+        assert tag == 'suppressed'
+        assert record['rate_limited'] == {'app': 1}
+
+    def test_async_send(self):
+        limiter = RateLimiter(rates={'app': (1, 1)})
+        sender = client.AsyncFluentSender(tag='app', rate_limiter=limiter)
+        sender._ensure_thread = MagicMock()
+        sender.send('first')
+        sender.send('second')
+        assert sender._buffered() == 1
+
+
+class TestSendMany(object):
+    def events(self, count, tag=None):
+        for i in range(count):
+            yield tag, 1.0, {'i': i}
+
+    def make_sender(self, **kwargs):
+        """Return a sender which moves its queue to a list when flushed."""
+        sender = client.FluentSender(tag='test', **kwargs)
+        sent = []
+
+        def flush_queue(*args, **kwargs):
+            sent.extend(sender._queue)
+            sender._queue.clear()
+            sender._queue_bytes = 0
+        sender._flush_queue = MagicMock(side_effect=flush_queue)
+        return sender, sent
+
+    def test_message_mode(self):
+        sender, frames = self.make_sender(batch_bytes=100)
+        assert sender.send_many(self.events(10)) == 10
+        assert len(frames) == 2
+        assert all(len(frame) >= 100 for frame in frames[:-1])
+        unpacker = msgpack.Unpacker(encoding='utf-8')
+        unpacker.feed(b''.join(frames))
+        assert list(unpacker) == [['test', 1.0, {'i': i}] for i in range(10)]
+        assert sender.events == 10
+
+    def test_forward_mode(self):
+        sender, sent = self.make_sender(mode=client.FORWARD_MODE,
+                                        batch_size=3)
+        events = list(self.events(4)) + [('other', 2.0, 'x')]
+        assert sender.send_many(events) == 5
+        frames = [msgpack.unpackb(x, encoding='utf-8') for x in sent]
+        assert frames == [
+            ['test', [[1.0, {'i': i}] for i in range(3)]],
+            ['test', [[1.0, {'i': 3}]]],
+            ['other', [[2.0, {'message': 'x'}]]],
+        ]
+
+    def test_streaming(self):
+        sender = client.FluentSender(tag='test', batch_bytes=100)
+        consumed = []
+
+        def events():
+            for i in range(100):
+                consumed.append(i)
+                yield None, 1.0, {'i': i}
+
+        def push_frame(frame, events):
+            # only the events of this frame were read
+            assert len(consumed) <= pushed[0] + events + 1
+            pushed[0] += events
+
+        pushed = [0]
+        sender._push_frame = push_frame
+        assert sender.send_many(events()) == 100
+        assert pushed[0] == 100
+
+    def test_order(self):
+        sender, sent = self.make_sender(mode=client.FORWARD_MODE)
+        sender.send('first', timestamp=1.0)
+        sender.send_many([(None, 2.0, 'second')])
+        frames = [msgpack.unpackb(x, encoding='utf-8') for x in sent]
+        assert [len(frame[1]) for frame in frames] == [1, 1]
+        assert frames[0][1][0][1] == {'message': 'first'}
+
+    def test_server_down(self):
+        sender = client.FluentSender(tag='test', batch_bytes=1024,
+                                     timeout=0.01)
+        sender._make_socket = MagicMock(side_effect=socket.error)
+        assert sender.send_many(self.events(1000)) == 1000
+        frame_size = max(len(x) for x in sender._queue)
+        assert sender._queue_bytes <= sender.batch_bytes + frame_size
+        assert sender.dropped
+
+    def test_not_reading(self):
+        server, sock = socket.socketpair()
+        sock.setblocking(False)
+        # fluentd does not read
+        try:
+            while True:
+                sock.send(b'\0' * 65536)
+        except socket.error:
+            pass
+        for overflow in (client.DROP_OLDEST, client.DROP_NEWEST):
+            sender = client.FluentSender(tag='test', batch_bytes=1024,
+                                         timeout=0.01, overflow=overflow)
+            sender._sock = sock
+            assert sender.send_many(self.events(1000)) == 1000
+            frame_size = max(len(x) for x in sender._queue)
+            assert sender._queue_bytes <= sender.batch_bytes + frame_size
+            assert sender.dropped
+        server.close()
+        sock.close()
+
+    def test_async_not_reading(self):
+        sender = client.AsyncFluentSender(tag='test', batch_bytes=1024,
+                                          timeout=0.01)
+        sender._ensure_thread = MagicMock()
+        assert sender.send_many(self.events(1000)) == 1000
+        frame_size = max(len(x) for x in sender._queue)
+        assert sender._queue_bytes <= sender.batch_bytes + frame_size
+        assert sender.dropped
+
+    def test_async(self):
+        server, sock = socket.socketpair()
+        sock.setblocking(False)
+        sender = client.AsyncFluentSender(tag='test', batch_bytes=1024)
+        sender._make_socket = lambda: sock
+        sender.send('first', timestamp=1.0)
+        assert sender.send_many(self.events(1000)) == 1000
+        unpacker = msgpack.Unpacker(encoding='utf-8')
+        messages = []
+        server.settimeout(5)
+        while len(messages) < 1001:
+            unpacker.feed(server.recv(65536))
+            messages.extend(unpacker)
+        assert messages[0] == ['test', 1.0, {'message': 'first'}]
+        assert [x[2]['i'] for x in messages[1:]] == list(range(1000))
+        sender.close()
+        server.close()
+
+
+class TestFluentClusterSender(object):
+    def make_sender(self, servers, **kwargs):
+        sender = client.FluentClusterSender(servers, tag='test', **kwargs)
+        for endpoint in sender.endpoints:
+            endpoint._flush_queue = MagicMock()
+        return sender
+
+    def test_init(self):
+        sender = self.make_sender([('a', 1), ('b', 2, 3)])
+        assert [(e.host, e.port, e.weight) for e in sender.endpoints] == [
+            ('a', 1, 1), ('b', 2, 3)
+        ]
+
+    def test_weighted_round_robin(self):
+        sender = self.make_sender([('a', 1, 5), ('b', 2, 1), ('c', 3, 1)])
+        for i in range(7):
+            sender.send(i)
+        assert [len(e._queue) for e in sender.endpoints] == [5, 1, 1]
+        assert len(sender._queue) == 0
+
+    def test_least_pending(self):
+        sender = self.make_sender([('a', 1), ('b', 2)],
+                                  balance=client.LEAST_PENDING)
+        sender.send('x' * 100)
+        sender.send('x')
+        sender.send('x')
+        assert [len(e._queue) for e in sender.endpoints] == [1, 2]
+
+    def test_failover(self):
+        sender = self.make_sender([('a', 1), ('b', 2)])
+        for i in range(4):
+            sender.send(i)
+        a, b = sender.endpoints
+        assert len(a._queue) == len(b._queue) == 2
+        a._retry_time = time.time() + 100
+        sender.send(4)
+        assert len(a._queue) == 0
+        assert len(b._queue) == 5
+        assert b._queue_bytes == sum(len(x) for x in b._queue)
+        assert sender.stats()['endpoints'][0]['healthy'] is False
+
+    def test_slow_endpoints(self):
+        sender = self.make_sender([('a', 1), ('b', 2)], timeout=0.01,
+                                  max_queue_bytes=500000, capacity=10)
+        for i in range(300):
+            sender.send('x' * 100000)
+        for endpoint in sender.endpoints:
+            assert endpoint._queue_bytes < sender.batch_bytes + 200000
+        held = sum(len(e._queue) for e in sender.endpoints)
+        assert len(sender._queue) <= 10
+        assert sender._queue_bytes <= 500000
+        assert sender.dropped == 300 - held - len(sender._queue)
+        assert sender.is_full(100000)
+
+    def test_all_down(self):
+        sender = self.make_sender([('a', 1), ('b', 2)])
+        for endpoint in sender.endpoints:
+            endpoint._retry_time = time.time() + 100
+        sender.send(0)
+        assert len(sender._queue) == 1
+        assert sender._pending()
+        for endpoint in sender.endpoints:
+            endpoint._retry_time = 0
+        sender.flush()
+        assert len(sender._queue) == 0
+        assert sum(len(e._queue) for e in sender.endpoints) == 1
+
+
+class TestAck(object):
+    def pytest_funcarg__pair(self, request):
+        server, sock = socket.socketpair()
+        sock.setblocking(False)
+        server.settimeout(5)
+        request.addfinalizer(server.close)
+        return server, sock
+
+    def receive(self, server, count):
+        unpacker = msgpack.Unpacker(encoding='utf-8')
+        frames = []
+        while len(frames) < count:
+            unpacker.feed(server.recv(65536))
+            frames.extend(unpacker)
+        return frames
+
+    def ack(self, server, frames):
+        server.sendall(b''.join(
+            msgpack.packb({'ack': x[-1]['chunk']}) for x in frames))
+
+    def test_chunk_option(self):
+        for mode in (client.MESSAGE_MODE, client.FORWARD_MODE,
+                     client.PACKED_FORWARD_MODE):
+            sender = client.FluentSender(tag='test', mode=mode,
+                                         require_ack=True)
+            sender._flush_queue = MagicMock()
+            sender.send('test', timestamp=1.0)
+            sender.flush()
+            frame = sender._queue[0]
+            option = msgpack.unpackb(frame, encoding='utf-8')[-1]
+            assert option['chunk'] == frame.chunk
+
+    def test_ack(self, pair):
+        server, sock = pair
+        sender = client.FluentSender(tag='test', require_ack=True)
+        sender._make_socket = lambda: sock
+        sender.send('test1')
+        sender.send('test2')
+        frames = self.receive(server, 2)
+        assert len(sender._unacked) == 2
+        self.ack(server, frames)
+        sender.flush()
+        assert len(sender._unacked) == 0
+        assert sender.acked == 2
+        assert sender.retried == 0
+
+    def test_window(self, pair):
+        server, sock = pair
+        sender = client.FluentSender(tag='test', require_ack=True,
+                                     ack_window=2, timeout=0.1)
+        sender._make_socket = lambda: sock
+        for i in range(3):
+            sender.send(i)
+        assert len(sender._unacked) == 2
+        assert len(sender._queue) == 1
+        self.ack(server, self.receive(server, 2))
+        sender.flush()
+        assert len(sender._unacked) == 1
+        assert len(sender._queue) == 0
+
+    def test_retransmit_on_reconnect(self, pair):
+        server, sock = pair
+        sender = client.FluentSender(tag='test', require_ack=True)
+        sender._make_socket = lambda: sock
+        sender.send('test1')
+        frames = self.receive(server, 1)
+        sender._disconnect()
+        assert len(sender._unacked) == 0
+        assert list(sender._queue) == [msgpack.packb(frames[0])]
+        assert sender._queue[0].chunk == frames[0][-1]['chunk']
+
+    def test_retransmit_with_capacity(self):
+        sender = client.FluentSender(tag='test', capacity=2)
+        sender._flush_queue = MagicMock()
+        sender.send('test1')
+        sender.send('test2')
+        sender._unacked['chunk'] = (b'x' * 10, time.time())
+        sender._requeue_unacked()
+        assert list(sender._queue)[0] == b'x' * 10
+        assert len(sender._queue) == 2
+        assert sender._queue_bytes == sum(len(x) for x in sender._queue)
+        assert sender.dropped == 1
+
+    def test_retransmit_on_timeout(self, pair):
+        server, sock = pair
+        sender = client.FluentSender(tag='test', require_ack=True,
+                                     ack_timeout=0)
+        sockets = [sock, MagicMock(spec=socket.socket)]
+        sender._make_socket = lambda: sockets.pop(0)
+        sender._flush_queue()
+        sender.send('test1')
+        assert len(sender._unacked) == 1
+        with patch('select.select') as select:
+            select.return_value = ([], [], [])
+            sender._flush_queue()
+        assert sender.retried == 1
+        assert len(sender._queue) == 1
+
+
+def test_unix_path():
+    assert client.unix_path('unix:///var/run/fluentd.sock') == \
+        '/var/run/fluentd.sock'
+    assert client.unix_path('unix://@fluentd') == '\0fluentd'
+    assert client.unix_path('localhost') is None
+    assert client.unix_path(None) is None
+
+
+class TestUnixSocket(object):
+    def pytest_funcarg__listener(self, request):
+        path = str(request.getfuncargvalue('tmpdir').join('fluentd.sock'))
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        listener.listen(1)
+        request.addfinalizer(listener.close)
+        return listener
+
+    def receive(self, listener, count):
+        conn = listener.accept()[0]
+        conn.settimeout(5)
+        unpacker = msgpack.Unpacker(encoding='utf-8')
+        messages = []
+        while len(messages) < count:
+            unpacker.feed(conn.recv(4096))
+            messages.extend(unpacker)
+        conn.close()
+        return messages
+
+    def test_send(self, listener):
+        sender = client.FluentSender('unix://' + listener.getsockname(),
+                                     None, 'test')
+        sender.send('test1', timestamp=1.0)
+        sender.send('test2', timestamp=2.0)
+        sender.close()
+        assert sender.connects == 1
+        assert self.receive(listener, 2) == [
+            ['test', 1.0, {'message': 'test1'}],
+            ['test', 2.0, {'message': 'test2'}]
+        ]
+
+    def test_unreachable(self, tmpdir):
+        path = str(tmpdir.join('missing.sock'))
+        sender = client.FluentSender('unix://' + path, None, 'test')
+        sender.send('test')
+        assert sender.connect_failures == 1
+        assert len(sender._queue) == 1
+
+
+class TestFork(object):
+    def test_after_fork(self):
+        sender = client.FluentSender(tag='test')
+        sender._flush_queue = MagicMock()
+        sender.send('test')
+        sock = sender._sock = MagicMock(spec=socket.socket)
+        sender._after_fork()
+        assert sock.close.call_count == 1
+        assert sender._sock is None
+        assert len(sender._queue) == 0
+        assert sender._queue_bytes == 0
+        assert sender.events == 0
+
+    def test_pid_check(self, monkeypatch):
+        monkeypatch.setattr(client, 'CHECK_PID', True)
+        sender = client.FluentSender(tag='test')
+        sender._flush_queue = MagicMock()
+        sender.send('test1')
+        sender._pid = -1
+        sender.send('test2')
+        assert len(sender._queue) == 1
+        assert sender._pid == os.getpid()
+
+    def test_async_after_fork(self):
+        sender = client.AsyncFluentSender(tag='test')
+        sender._flush_queue = MagicMock()
+        sender.send('test')
+        cond = sender._cond
+        sender._after_fork()
+        assert sender._cond is not cond
+        assert sender._thread is None
+        assert len(sender._queue) == 0
+        sender.close(0.1)
+
+    @pytest.mark.skipif('not hasattr(os, "register_at_fork")')
+    def test_fork(self):
+        sender = client.FluentSender(tag='test')
+        sender._make_socket = MagicMock(side_effect=socket.error)
+        sender.send('test')
+        assert len(sender._queue) == 1
+        pid = os.fork()
+        if pid == 0:
+            os._exit(len(sender._queue) + sender.connect_failures)
+        assert os.waitpid(pid, 0)[1] == 0
+        assert len(sender._queue) == 1
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Yoshihisa Tanaka
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+
+import msgpack
+from mock import patch
+
+from pyfluent.clock import Clock, EventTime, time_ns
+
+
+def test_event_time():
+    t = EventTime(1500000000, 123456789)
+    assert t.packed == b'\xd7\x00' + b'\x59\x68\x2f\x00' + b'\x07\x5b\xcd\x15'
+    assert msgpack.unpackb(t.packed) == msgpack.ExtType(0, t.packed[2:])
+    assert t.to_ext() == msgpack.ExtType(0, t.packed[2:])
+    assert float(t) == 1500000000.123456789
+    assert EventTime.from_ns(1500000000123456789) == t
+    assert EventTime.from_float(1500000000.5) == EventTime(1500000000,
+                                                           500000000)
+    # the fraction rounds up to the next second
+    assert EventTime.from_float(1.9999999999) == EventTime(2, 0)
+
+
+def test_time_ns():
+    now = time.time()
+    assert now - 1 < time_ns() / 1e9 < now + 1
+
+
+def test_plain_clock():
+    clock = Clock()
+    assert type(clock.now()) is float
+    assert clock.timestamp(1000) == 1000
+    assert clock.timestamp(1000.5) == 1000.5
+
+
+def test_nanosecond_precision():
+    clock = Clock(nanosecond_precision=True)
+    with patch('pyfluent.clock.time_ns', return_value=1500000000123456789):
+        assert clock.now() == EventTime(1500000000, 123456789)
+        assert clock.timestamp() == EventTime(1500000000, 123456789)
+    assert clock.timestamp(1000.25) == EventTime(1000, 250000000)
+    t = EventTime(1, 2)
+    assert clock.timestamp(t) is t
+
+
+def test_resolution():
+    clock = Clock(nanosecond_precision=True, resolution=0.1)
+    with patch('pyfluent.clock.time_ns', return_value=1500000000123456789):
+        t = clock.now()
+    assert t == EventTime(1500000000, 100000000)
+    with patch('pyfluent.clock.time_ns', return_value=1500000000199999999):
+        # the same object within a tick
+        assert clock.now() is t
+    with patch('pyfluent.clock.time_ns', return_value=1500000000200000000):
+        assert clock.now() == EventTime(1500000000, 200000000)
+
+
+def test_resolution_float():
+    clock = Clock(resolution=1)
+    assert clock.timestamp(1000.75) == 1000.0
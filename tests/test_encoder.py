@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Yoshihisa Tanaka
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import decimal
+import uuid
+
+import msgpack
+
+from pyfluent.clock import EventTime
+from pyfluent.encoder import EncoderRegistry, registry
+
+
+def pack(obj, default=registry):
+    packed = msgpack.packb(obj, encoding='utf-8', default=default)
+    return msgpack.unpackb(packed, encoding='utf-8')
+
+
+class Point(object):
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+    def __repr__(self):
+        return 'Point(%d, %d)' % (self.x, self.y)
+
+
+def test_default_encoders():
+    record = {
+        'datetime': datetime.datetime(2019, 1, 10, 12, 30),
+        'date': datetime.date(2019, 1, 10),
+        'timedelta': datetime.timedelta(seconds=1.5),
+        'decimal': decimal.Decimal('1.10'),
+        'uuid': uuid.UUID(int=1),
+        'set': set([1]),
+        'error': ValueError('invalid'),
+        'time': EventTime(1, 2),
+    }
+    assert pack(record) == {
+        'datetime': '2019-01-10T12:30:00',
+        'date': '2019-01-10',
+        'timedelta': 1.5,
+        'decimal': '1.10',
+        'uuid': '00000000-0000-0000-0000-000000000001',
+        'set': [1],
+        'error': 'ValueError: invalid',
+        'time': msgpack.ExtType(0, EventTime(1, 2).packed[2:]),
+    }
+
+
+def test_fallback():
+    assert pack({'point': Point(1, 2)}) == {'point': 'Point(1, 2)'}
+
+
+def test_register():
+    encoders = registry.copy()
+    assert pack(Point(1, 2), encoders) == 'Point(1, 2)'
+    encoders.register(Point, lambda p: [p.x, p.y])
+    assert pack(Point(1, 2), encoders) == [1, 2]
+    # the registry of senders is not changed
+    assert pack(Point(1, 2)) == 'Point(1, 2)'
+
+
+def test_subclass():
+    class Point3D(Point):
+        pass
+
+    encoders = EncoderRegistry()
+    encoders.register(Point, lambda p: [p.x, p.y])
+    assert pack(Point3D(1, 2), encoders) == [1, 2]
+    assert encoders._cache == {Point3D: encoders._encoders[Point]}
+    encoders.unregister(Point)
+    assert pack(Point3D(1, 2), encoders) == 'Point(1, 2)'
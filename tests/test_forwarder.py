@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Yoshihisa Tanaka
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import socket
+
+import msgpack
+import pytest
+
+from pyfluent import client
+from pyfluent.forwarder import Forwarder, frame_chunk
+
+
+def pytest_funcarg__upstream(request):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    listener.settimeout(5)
+    request.addfinalizer(listener.close)
+    return listener
+
+
+def pytest_funcarg__forwarder(request):
+    upstream = request.getfuncargvalue('upstream')
+    path = str(request.getfuncargvalue('tmpdir').join('forwarder.sock'))
+    forwarder = Forwarder(path, '127.0.0.1', upstream.getsockname()[1])
+    request.addfinalizer(lambda: forwarder.stop(5))
+    return forwarder.start()
+
+
+def receive(listener, count):
+    conn = listener.accept()[0]
+    conn.settimeout(5)
+    unpacker = msgpack.Unpacker(encoding='utf-8')
+    messages = []
+    while len(messages) < count:
+        unpacker.feed(conn.recv(4096))
+        messages.extend(unpacker)
+    conn.close()
+    return messages
+
+
+@pytest.mark.parametrize(('obj', 'expected'), [
+    (['tag', 1.0, {'message': 'test'}], None),
+    (['tag', 1.0, {'message': 'test'}, {'chunk': 'c1'}], 'c1'),
+    (['tag', [[1.0, {'message': 'test'}]]], None),
+    (['tag', [[1.0, {'message': 'test'}]], {'chunk': 'c2'}], 'c2'),
+    (['tag', b'entries', {'size': 1, 'chunk': 'c3'}], 'c3'),
+    ({'ack': 'c4'}, None)
+])
+def test_frame_chunk(obj, expected):
+    assert frame_chunk(obj) == expected
+
+
+def test_relay(upstream, forwarder):
+    senders = [client.FluentSender(forwarder.address, None, 'worker%d' % i)
+               for i in range(2)]
+    for i, sender in enumerate(senders):
+        sender.send('test', timestamp=1.0)
+        sender.close()
+    messages = receive(upstream, 2)
+    assert sorted(messages) == [
+        ['worker0', 1.0, {'message': 'test'}],
+        ['worker1', 1.0, {'message': 'test'}]
+    ]
+
+
+def test_relay_forward_mode(upstream, forwarder):
+    sender = client.FluentSender(forwarder.address, None, 'test',
+                                 mode=client.PACKED_FORWARD_MODE)
+    for i in range(3):
+        sender.send('test%d' % i, timestamp=1.0)
+    sender.close()
+    tag, entries, option = receive(upstream, 1)[0]
+    assert tag == 'test'
+    assert option == {'size': 3}
+
+
+def test_ack(upstream, forwarder):
+    sender = client.FluentSender(forwarder.address, None, 'test',
+                                 require_ack=True)
+    sender.send('test', timestamp=1.0)
+    sender.flush()
+    assert sender.acked == 1
+    assert len(sender._unacked) == 0
+    sender.close()
+    message = receive(upstream, 1)[0]
+    assert message[:3] == ['test', 1.0, {'message': 'test'}]
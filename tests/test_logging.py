@@ -16,16 +16,21 @@
 from __future__ import with_statement
 
 import os
+import datetime
 import sys
 import logging
 import socket
+import threading
+import time
 
 import pytest
 import msgpack
 from mock import MagicMock, Mock, patch, call
 
 import pyfluent.logging
-from pyfluent.logging import SafeFluentHandler
+from pyfluent.clock import EventTime
+from pyfluent.ratelimit import RateLimiter
+from pyfluent.logging import BatchingFluentHandler, SafeFluentHandler
 
 _RECORD_CREATED = 1329904180.791739
 
@@ -67,9 +72,13 @@ class TestFluentHandler(object):
         body = {'message': 'message 1'}
         handler_without_tag = pyfluent.logging.FluentHandler()
         handler_with_tag = pyfluent.logging.FluentHandler(tag='test')
+        handler_event_time = pyfluent.logging.FluentHandler(
+            tag='test', nanosecond_precision=True)
+        event_time = EventTime.from_float(_RECORD_CREATED).to_ext()
         metafunc.parametrize(('handler', 'expected'), [
             (handler_without_tag, ['info', _RECORD_CREATED, body]),
             (handler_with_tag, ['test.info', _RECORD_CREATED, body]),
+            (handler_event_time, ['test.info', event_time, body]),
         ])
 
     def test_packing(self, handler, record, expected):
@@ -77,6 +86,30 @@ class TestFluentHandler(object):
         assert msgpack.unpackb(data, encoding='utf-8') == expected
 
 
+def test_handler_unknown_types(record):
+    handler = pyfluent.logging.FluentHandler(tag='test')
+    handler.setFormatter(pyfluent.logging.FluentFormatter())
+    record.date = datetime.date(2019, 1, 10)
+    data = msgpack.unpackb(handler.makePickle(record), encoding='utf-8')
+    assert data[2]['date'] == '2019-01-10'
+
+
+def test_handler_unix_socket(tmpdir, record):
+    path = str(tmpdir.join('fluentd.sock'))
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(1)
+    handler = pyfluent.logging.FluentHandler('unix://' + path, None, 'test')
+    handler.emit(record)
+    handler.close()
+    conn = listener.accept()[0]
+    data = conn.recv(4096)
+    conn.close()
+    listener.close()
+    assert msgpack.unpackb(data, encoding='utf-8') == [
+        'test.info', _RECORD_CREATED, {'message': 'message 1'}]
+
+
 class TestSafeFluentHandler(object):
     def pytest_funcarg__handler(self, request):
         handler = pyfluent.logging.SafeFluentHandler()
@@ -178,3 +211,311 @@ class TestFluentFormatter(object):
         assert data['name'] == 'pytest.fluent'
         assert data['message'] == 'message for test'
         assert data['additional'] == 'information'
+
+
+def test_traceback_fingerprints():
+    formatter = pyfluent.logging.FluentFormatter(traceback_fingerprints=True)
+    results = []
+    for n in range(2):
+        try:
+            raise ValueError('error %d' % n)
+        except ValueError:
+            record = make_record('failed', (), exc_info=sys.exc_info())
+        results.append(formatter.format(record))
+    first, second = results
+    assert first['exc_fingerprint'] == second['exc_fingerprint']
+    assert 'Traceback' in first['message']
+    assert first['exc_text'].startswith('Traceback')
+    assert second['message'] == 'failed\nValueError: error 1'
+    assert second['exc_text'] == 'ValueError: error 1'
+
+
+def test_safe_handler_caches_tracebacks(record):
+    handler = SafeFluentHandler(tag='test')
+    handler.fluent = MagicMock()
+    try:
+        raise ValueError('error')
+    except ValueError:
+        record.exc_info = sys.exc_info()
+    with patch.object(pyfluent.logging._default_formatter.tracebacks,
+                      'format', return_value='traceback') as format:
+        handler.emit(record)
+        assert format.call_count == 1
+    assert handler.fluent.send.call_args[0][0] == 'message 1\ntraceback'
+
+
+class TestCompiledFluentFormatter(object):
+    def test_same_as_fluent_formatter(self, record):
+        fmt = pyfluent.logging.CompiledFluentFormatter()
+        assert fmt.format(record) == \
+            pyfluent.logging.FluentFormatter().format(record)
+
+    def test_plain_message(self, record):
+        fmt = pyfluent.logging.CompiledFluentFormatter()
+        with patch('logging.Formatter.format') as format:
+            assert fmt.format(record)['message'] == 'message 1'
+            assert format.call_count == 0
+        fmt = pyfluent.logging.CompiledFluentFormatter('%(levelname)s')
+        assert fmt.format(record)['message'] == 'INFO'
+
+    def test_exception(self, record):
+        try:
+            raise ValueError('error')
+        except ValueError:
+            record.exc_info = sys.exc_info()
+        fmt = pyfluent.logging.CompiledFluentFormatter()
+        data = fmt.format(record)
+        assert data['message'].startswith('message 1\nTraceback')
+        assert data['exc_text'] == data['message'][len('message 1\n'):]
+
+    def test_plan_cache(self, record):
+        fmt = pyfluent.logging.CompiledFluentFormatter()
+        fmt.format(record)
+        fmt.format(record)
+        assert len(fmt._plans) == 1
+        record.extra = 'value'
+        assert fmt.format(record)['extra'] == 'value'
+        assert len(fmt._plans) == 2
+
+    def test_exclude(self, record):
+        fmt = pyfluent.logging.CompiledFluentFormatter()
+        assert 'threadName' in fmt.format(record)
+        fmt.exclude += ['threadName']
+        assert 'threadName' not in fmt.format(record)
+
+    def test_include_and_converters(self, record):
+        fmt = pyfluent.logging.CompiledFluentFormatter(
+            include=['levelname', 'lineno'], converters={'lineno': int})
+        assert fmt.format(record) == {
+            'message': 'message 1',
+            'hostname': socket.gethostname(),
+            'levelname': 'info',
+            'lineno': 10
+        }
+
+    def test_converter_error(self, record):
+        fmt = pyfluent.logging.CompiledFluentFormatter(
+            include=['funcName'], converters={'funcName': int})
+        assert fmt.format(record)['funcName'] == 'func_name'
+
+
+def test_level_tag():
+    assert pyfluent.logging.level_tag('app', 'INFO') == 'app.info'
+    assert pyfluent.logging.level_tag('', 'WARNING') == 'warning'
+    assert pyfluent.logging.level_tag('app', 'INFO') is \
+        pyfluent.logging.level_tag('app', 'INFO')
+
+
+def test_safe_handler_clock(record):
+    handler = SafeFluentHandler(tag='test', nanosecond_precision=True,
+                                clock_resolution=1)
+    handler.fluent._make_socket = MagicMock(side_effect=socket.error)
+    handler.emit(record)
+    frame = msgpack.unpackb(handler.fluent._queue[0], encoding='utf-8')
+    assert frame[1] == EventTime(int(_RECORD_CREATED), 0).to_ext()
+
+
+def test_safe_handler_rate_limiter(record):
+    limiter = RateLimiter(rates={'test.info': (1, 1)})
+    handler = SafeFluentHandler(tag='test', rate_limiter=limiter)
+    handler.fluent = MagicMock()
+    handler.format = MagicMock(return_value='message')
+    handler.emit(record)
+    handler.emit(record)
+    record.levelname = 'ERROR'
+    handler.emit(record)
+    assert handler.fluent.send.call_count == 2
+    # suppressed records are not formatted
+    assert handler.format.call_count == 2
+
+
+def make_record(msg='message %d', args=(1, ), created=_RECORD_CREATED,
+                level=logging.ERROR, exc_info=None):
+    record = logging.LogRecord('root', level, '/path/to/source.py', 10, msg,
+                               args, exc_info, 'func_name')
+    record.created = created
+    return record
+
+
+class TestAggregation(object):
+    def pytest_funcarg__handler(self, request):
+        handler = SafeFluentHandler(tag='test', aggregate_window=10)
+        handler.fluent = MagicMock()
+        return handler
+
+    def test_repeated(self, handler):
+        handler.emit(make_record(args=(1, ), created=100))
+        handler.emit(make_record(args=(2, ), created=101))
+        handler.emit(make_record(args=(3, ), created=102))
+        handler.emit(make_record('other', (), created=103))
+        assert handler.fluent.send.call_count == 2
+        # the window closes
+        handler.emit(make_record(args=(4, ), created=111))
+        assert handler.fluent.send.call_count == 4
+        data, tag, timestamp = handler.fluent.send.call_args_list[2][0]
+        assert data == {'message': 'message 2', 'count': 2,
+                        'first_time': 101, 'last_time': 102}
+        assert tag == 'test.error'
+        assert timestamp == 101
+        # a new window was opened
+        assert handler.fluent.send.call_args[0][0] == 'message 4'
+
+    def test_level(self, handler):
+        handler.emit(make_record(created=100))
+        handler.emit(make_record(created=101, level=logging.WARNING))
+        assert handler.fluent.send.call_count == 2
+
+    def test_exception_location(self, handler):
+        def fail(n):
+            if n:
+                raise ValueError
+            raise ValueError
+
+        records = []
+        for n in (0, 0, 1):
+            try:
+                fail(n)
+            except ValueError:
+                records.append(make_record(exc_info=sys.exc_info()))
+        key = pyfluent.logging.aggregate_key
+        assert key(records[0]) == key(records[1])
+        assert key(records[0]) != key(records[2])
+
+    def test_flush(self, handler):
+        handler.emit(make_record(created=100))
+        handler.emit(make_record(created=101))
+        handler.flush()
+        assert handler.fluent.send.call_count == 2
+        assert handler.fluent.send.call_args[0][0]['count'] == 1
+        handler.close()
+        assert handler.fluent.send.call_count == 2
+
+    def test_unhashable(self, handler):
+        handler.emit(make_record({'message': 'dict'}, (), created=100))
+        handler.emit(make_record({'message': 'dict'}, (), created=100))
+        assert handler.fluent.send.call_count == 2
+
+
+def test_safe_handler_async_send():
+    handler = SafeFluentHandler(async_send=True)
+    assert isinstance(handler.fluent, pyfluent.logging.AsyncFluentSender)
+    handler = SafeFluentHandler()
+    assert not isinstance(handler.fluent, pyfluent.logging.AsyncFluentSender)
+
+
+def test_safe_handler_lock(record):
+    handler = SafeFluentHandler(async_send=True)
+    handler.fluent = MagicMock(spec=handler.fluent)
+    handler.fluent.thread_safe = True
+    handler.lock = MagicMock()
+    handler.handle(record)
+    assert handler.lock.acquire.call_count == 0
+    assert handler.fluent.send.call_count == 1
+    handler = SafeFluentHandler()
+    handler.fluent = MagicMock(spec=handler.fluent)
+    handler.fluent.thread_safe = False
+    handler.lock = MagicMock()
+    handler.handle(record)
+    assert handler.lock.acquire.call_count == 1
+
+
+def test_safe_handler_overflow_level(record):
+    handler = SafeFluentHandler(overflow_level=logging.WARNING)
+    handler.fluent = MagicMock(spec=handler.fluent.__class__)
+    handler.fluent.is_full.return_value = False
+    handler.emit(record)
+    assert handler.dropped == 0
+    handler.fluent.is_full.return_value = True
+    handler.emit(record)
+    assert handler.dropped == 1
+    record.levelno = logging.ERROR
+    handler.emit(record)
+    assert handler.dropped == 1
+    assert len(handler.fluent.send.call_args_list) == 2
+
+
+class TestBatchingFluentHandler(object):
+    def pytest_funcarg__handler(self, request):
+        handler = BatchingFluentHandler(tag='test', flush_interval=60,
+                                        batch_size=3, queue_size=5)
+        handler.fluent = MagicMock(spec=handler.fluent.__class__)
+        handler.fluent.timeout = 5
+        request.addfinalizer(handler.close)
+        return handler
+
+    def wait_sent(self, handler, count):
+        sent = threading.Event()
+
+        def flush():
+            if handler.fluent.send.call_count >= count:
+                sent.set()
+        handler.fluent.flush.side_effect = flush
+        return sent
+
+    def test_enqueue(self, handler):
+        handler.lock = MagicMock()
+        handler.handle(make_record(level=logging.INFO))
+        assert handler.lock.acquire.call_count == 0
+        assert handler.fluent.send.call_count == 0
+        assert handler.flush()
+        assert handler.fluent.method_calls == [
+            call.send('message 1', 'test.info', _RECORD_CREATED),
+            call.flush(),
+        ]
+
+    def test_flush_level(self, handler):
+        sent = self.wait_sent(handler, 2)
+        handler.handle(make_record(level=logging.INFO))
+        handler.handle(make_record(level=logging.ERROR))
+        assert sent.wait(5)
+        tags = [c[0][1] for c in handler.fluent.send.call_args_list]
+        assert tags == ['test.info', 'test.error']
+
+    def test_batch_size(self, handler):
+        sent = self.wait_sent(handler, 3)
+        for i in range(3):
+            handler.handle(make_record(level=logging.INFO))
+        assert sent.wait(5)
+
+    def test_queue_size(self, handler):
+        sending = threading.Event()
+        release = threading.Event()
+
+        def send(*args):
+            sending.set()
+            release.wait(5)
+        handler.fluent.send.side_effect = send
+        handler.handle(make_record(level=logging.ERROR))
+        assert sending.wait(5)
+        for i in range(6):
+            handler.handle(make_record(level=logging.DEBUG))
+        assert handler.dropped == 1
+        release.set()
+        assert handler.flush()
+        assert handler.fluent.send.call_count == 6
+
+    def test_close(self, handler):
+        handler.handle(make_record(level=logging.INFO))
+        handler.close()
+        assert handler.fluent.send.call_count == 1
+        assert handler.fluent.close.call_count == 1
+        assert not handler._thread.is_alive()
+
+    def test_close_without_worker(self, handler):
+        handler.close()
+        assert handler._thread is None
+        assert handler.fluent.close.call_count == 1
+
+    def test_aggregate_window_expires(self):
+        handler = BatchingFluentHandler(tag='test', flush_interval=0.05,
+                                        aggregate_window=0.1)
+        handler.fluent = MagicMock(spec=handler.fluent.__class__)
+        handler.fluent.timeout = 5
+        sent = self.wait_sent(handler, 2)
+        now = time.time()
+        handler.handle(make_record(level=logging.INFO, created=now))
+        handler.handle(make_record(level=logging.INFO, created=now))
+        assert sent.wait(5)
+        data = handler.fluent.send.call_args[0][0]
+        assert data['count'] == 1
+        handler.close()
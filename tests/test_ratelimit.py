@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Yoshihisa Tanaka
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from mock import patch
+
+from pyfluent.ratelimit import RateLimiter, TokenBucket, match
+
+
+def test_token_bucket():
+    bucket = TokenBucket(2, 3, now=100)
+    assert [bucket.take(100) for i in range(4)] == [True, True, True, False]
+    assert bucket.take(100.5)
+    assert not bucket.take(100.5)
+    # refilled up to the burst
+    assert [bucket.take(200) for i in range(4)] == [True, True, True, False]
+
+
+def test_match():
+    rules = {'app': 1, 'app.debug': 2}
+    assert match(rules, 'app') == 1
+    assert match(rules, 'app.info') == 1
+    assert match(rules, 'app.debug') == 2
+    assert match(rules, 'app.debug.sql') == 2
+    assert match(rules, 'application') is None
+    assert match(rules, 'other', 3) == 3
+
+
+def test_rate_per_tag():
+    limiter = RateLimiter(rates={'app': (1, 2)})
+    assert [limiter.allow('app.error', 100) for i in range(3)] == [
+        True, True, False]
+    # each tag has its own bucket
+    assert limiter.allow('app.info', 100)
+    # tags without a rule are not limited
+    assert all(limiter.allow('other', 100) for i in range(100))
+    assert limiter.suppressed == 1
+
+
+def test_default_rate():
+    limiter = RateLimiter(rate=1, rates={'audit': (None, None)})
+    assert limiter.allow('app', 100)
+    assert not limiter.allow('app', 100)
+    assert all(limiter.allow('audit', 100) for i in range(10))
+
+
+def test_sample():
+    limiter = RateLimiter(sample={'app.debug': 0.25})
+    with patch('random.random', side_effect=[0.1, 0.5, 0.2, 0.9]):
+        results = [limiter.allow('app.debug', 100) for i in range(4)]
+    assert results == [True, False, True, False]
+    assert limiter.allow('app.info', 100)
+
+
+def test_summary():
+    limiter = RateLimiter(rate=1, sample={'app.debug': 0},
+                          summary_tag='pyfluent.suppressed',
+                          summary_interval=10)
+    now = limiter._next_summary - 10
+    limiter.allow('app.info', now)
+    limiter.allow('app.info', now)
+    limiter.allow('app.debug', now)
+    assert limiter.summary(now) is None
+    assert limiter.summary(now + 10) == {
+        'rate_limited': {'app.info': 1},
+        'sampled_out': {'app.debug': 1},
+        'interval': 10
+    }
+    assert limiter.summary(now + 20) is None
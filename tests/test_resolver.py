@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Yoshihisa Tanaka
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import socket
+import threading
+
+import pytest
+from mock import patch
+
+from pyfluent.resolver import Resolver, numeric_address
+
+
+def test_numeric_address():
+    assert numeric_address('127.0.0.1', 24224) == (
+        socket.AF_INET, ('127.0.0.1', 24224))
+    assert numeric_address('localhost', 24224) is None
+
+
+def test_lookup_numeric():
+    resolver = Resolver()
+    with patch('threading.Thread') as thread:
+        address = resolver.lookup('127.0.0.1', 24224)
+        assert address == [(socket.AF_INET, ('127.0.0.1', 24224))]
+        assert thread.call_count == 0
+
+
+def test_lookup_in_background():
+    resolver = Resolver()
+    started = threading.Event()
+    release = threading.Event()
+    getaddrinfo = socket.getaddrinfo
+
+    def slow_getaddrinfo(*args):
+        started.set()
+        release.wait(5)
+        return getaddrinfo('127.0.0.1', 24224, 0, socket.SOCK_STREAM)
+
+    with patch('socket.getaddrinfo', side_effect=slow_getaddrinfo):
+        assert resolver.lookup('fluent.example.com', 24224) is None
+        assert started.wait(5)
+        assert resolver.lookup('fluent.example.com', 24224) is None
+        release.set()
+        address = resolver.lookup('fluent.example.com', 24224, timeout=5)
+    assert address == [(socket.AF_INET, ('127.0.0.1', 24224))]
+
+
+def test_lookup_all_addresses():
+    resolver = Resolver()
+    info = [
+        (socket.AF_INET6, socket.SOCK_STREAM, 6, '', ('::1', 24224, 0, 0)),
+        (socket.AF_INET, socket.SOCK_STREAM, 6, '', ('127.0.0.1', 24224)),
+        (socket.AF_INET, socket.SOCK_STREAM, 6, '', ('127.0.0.1', 24224)),
+    ]
+    with patch('socket.getaddrinfo', return_value=info):
+        addresses = resolver.lookup('localhost', 24224, timeout=5)
+    assert addresses == [(socket.AF_INET6, ('::1', 24224, 0, 0)),
+                         (socket.AF_INET, ('127.0.0.1', 24224))]
+
+
+def test_lookup_expired():
+    resolver = Resolver(ttl=0)
+    address = resolver.lookup('localhost', 24224, timeout=5)
+    assert address is not None
+    # the expired address is used while it is refreshed
+    assert resolver.lookup('localhost', 24224) == address
+
+
+def test_lookup_error():
+    resolver = Resolver()
+    error = socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+    with patch('socket.getaddrinfo', side_effect=error):
+        with pytest.raises(socket.gaierror):
+            resolver.lookup('fluent.invalid', 24224, timeout=5)
+    with pytest.raises(socket.gaierror):
+        resolver.lookup('fluent.invalid', 24224)
+
+
+def test_lookup_unexpected_error():
+    resolver = Resolver()
+    error = UnicodeError('label empty or too long')
+    with patch('socket.getaddrinfo', side_effect=error):
+        with pytest.raises(socket.gaierror):
+            resolver.lookup('a..b', 24224, timeout=5)
+    assert not resolver._pending
+    # the failure is cached like a resolution error
+    with pytest.raises(socket.gaierror):
+        resolver.lookup('a..b', 24224)
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Yoshihisa Tanaka
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from pyfluent.stats import Histogram
+
+
+def test_empty():
+    h = Histogram()
+    assert h.snapshot() == {
+        'count': 0, 'mean': 0.0, 'p50': 0.0, 'p90': 0.0, 'p99': 0.0,
+        'max': 0.0
+    }
+
+
+def test_percentile():
+    h = Histogram()
+    for i in range(99):
+        h.observe(0.000010)
+    h.observe(0.5)
+    assert h.count == 100
+    assert h.max == 0.5
+    assert 0.000010 <= h.percentile(50) < 0.000020
+    assert 0.000010 <= h.percentile(99) < 0.000020
+    assert h.percentile(100) == 0.5
+
+
+def test_bounds():
+    h = Histogram(size=4)
+    h.observe(0)
+    h.observe(3600)
+    assert h.buckets == [1, 0, 0, 1]
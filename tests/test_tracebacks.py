@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Yoshihisa Tanaka
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import sys
+
+import pytest
+from mock import patch
+
+from pyfluent.tracebacks import TracebackCache
+
+
+def fail(message):
+    raise ValueError(message)
+
+
+def exc_info(func, *args):
+    try:
+        func(*args)
+    except Exception:
+        return sys.exc_info()
+
+
+def chained(message):
+    try:
+        fail(message)
+    except ValueError:
+        raise KeyError(message)
+
+
+def test_format():
+    cache = TracebackCache()
+    formatter = logging.Formatter()
+    for func in (fail, chained):
+        ei = exc_info(func, 'message')
+        assert cache.format(ei) == formatter.formatException(ei)
+
+
+def group(message):
+    errors = []
+    for func in (fail, chained):
+        try:
+            func(message)
+        except Exception as e:
+            errors.append(e)
+    raise ExceptionGroup('errors', errors)  # noqa: F821
+
+
+def in_group(message):
+    try:
+        group(message)
+    except Exception:
+        raise KeyError(message)
+
+
+@pytest.mark.skipif(sys.version_info < (3, 11),
+                    reason='ExceptionGroup requires Python 3.11')
+def test_format_exception_group():
+    cache = TracebackCache()
+    formatter = logging.Formatter()
+    for func in (group, in_group):
+        ei = exc_info(func, 'message')
+        text = cache.format(ei)
+        assert text == formatter.formatException(ei)
+        assert 'ValueError: message' in text
+
+
+def test_cached():
+    cache = TracebackCache()
+    first = exc_info(fail, 'first')
+    second = exc_info(fail, 'second')
+    assert cache.format(first).endswith('ValueError: first')
+    with patch('traceback.format_tb') as format_tb:
+        assert cache.format(second).endswith('ValueError: second')
+        assert format_tb.call_count == 0
+    assert len(cache) == 1
+
+
+def test_fingerprint():
+    cache = TracebackCache()
+    first = exc_info(fail, 'first')
+    assert cache.fingerprint(first) == cache.fingerprint(
+        exc_info(fail, 'second'))
+    assert cache.fingerprint(first) != cache.fingerprint(
+        exc_info(chained, 'first'))
+    # independent of the cache
+    assert TracebackCache().fingerprint(first) == cache.fingerprint(first)
+
+
+def test_reference():
+    cache = TracebackCache(maxsize=1)
+    first = exc_info(fail, 'first')
+    fingerprint, new = cache.reference(first)
+    assert new
+    assert cache.reference(exc_info(fail, 'second')) == (fingerprint, False)
+    cache.reference(exc_info(chained, 'other'))
+    # evicted
+    assert cache.reference(first) == (fingerprint, True)